@@ -7,12 +7,15 @@ import sys
 import click
 import yaml
 
+from . import api
 from . import cache
 from . import command_help
 from . import docs
 from . import edit as editlib
 from . import log_util
+from . import recording
 from . import security
+from . import trace
 
 
 ###################################################################
@@ -32,8 +35,80 @@ Refer to help for the commands below for more information.
 
 @click.group(help=base_help)
 @click.option("--debug", is_flag=True, help="Enable debug logging")
-def myguild(debug=False):
+@click.option(
+    "--url",
+    metavar="URL",
+    envvar="MY_GUILD_URL",
+    help=(
+        "Base URL of the Discourse site (default is %s). May also be set "
+        "using MY_GUILD_URL. Other sites are cached separately unless "
+        "MY_GUILD_CACHE_DIR is set." % api.DEFAULT_BASE_URL
+    ),
+)
+@click.option(
+    "--record",
+    metavar="DIR",
+    help="Record HTTP exchanges and Guild help output to DIR.",
+)
+@click.option(
+    "--replay",
+    metavar="DIR",
+    help=(
+        "Replay HTTP exchanges and Guild help output recorded to DIR "
+        "using '--record'. Nothing is sent to the site and credentials "
+        "are not required."
+    ),
+)
+@click.option(
+    "--replay-latency",
+    metavar="SECONDS",
+    help=(
+        "Seconds to delay each replayed exchange. Use 'recorded' to "
+        "delay by the recorded duration."
+    ),
+)
+@click.option(
+    "--trace",
+    "trace_path",
+    metavar="FILE",
+    help=(
+        "Write a JSON line to FILE for each HTTP request, cache read, "
+        "retry, and Guild help read."
+    ),
+)
+def myguild(
+    debug=False,
+    url=None,
+    record=None,
+    replay=None,
+    replay_latency=None,
+    trace_path=None,
+):
     log_util.init(debug)
+    if trace_path:
+        trace.start(trace_path)
+    if url:
+        api.set_base_url(url)
+    if record and replay:
+        raise SystemExit("--record and --replay cannot both be used")
+    if replay_latency and not replay:
+        raise SystemExit("--replay-latency requires --replay")
+    if record:
+        recording.start_record(record)
+    elif replay:
+        recording.start_replay(replay, _replay_latency(replay_latency))
+
+
+def _replay_latency(val):
+    if not val or val == "recorded":
+        return val
+    try:
+        return float(val)
+    except ValueError:
+        raise SystemExit(
+            "invalid value for --replay-latency: %r (expected SECONDS or "
+            "'recorded')" % val
+        )
 
 
 ###################################################################
@@ -78,6 +153,35 @@ def publish_docs_index(**opts):
     docs.publish_index(**opts)
 
 
+###################################################################
+# Command help options
+###################################################################
+
+
+def _command_help_options(f):
+    f = click.option(
+        "--guild-exe",
+        metavar="PATH",
+        help=(
+            "Guild executable used to read command help. By default help "
+            "is read from the Guild package installed with my-guild or, if "
+            "Guild cannot be imported, from 'guild'."
+        ),
+    )(f)
+    f = click.option(
+        "-j",
+        "--jobs",
+        metavar="N",
+        type=click.IntRange(min=1),
+        default=1,
+        help=(
+            "Number of concurrent jobs (default is 1). Applies to reading "
+            "help from a Guild executable and to reading published topics."
+        ),
+    )(f)
+    return f
+
+
 ###################################################################
 # publish-commands
 ###################################################################
@@ -94,6 +198,7 @@ specify one or more arguments for COMMAND.
 @click.argument("commands", metavar="[COMMAND]...", nargs=-1)
 @click.option("-p", "--preview", is_flag=True, help="Preview published topics.")
 @click.option("-c", "--check", is_flag=True, help="Check published topics.")
+@_command_help_options
 def publish_commands(commands, **opts):
     command_help.publish_commands(commands, **opts)
 
@@ -125,6 +230,7 @@ with an error.
         "Maybe be specified multiple times."
     ),
 )
+@_command_help_options
 def publish_commands_index(**opts):
     command_help.publish_index(**opts)
 
@@ -147,8 +253,9 @@ permalinks.
 
 @myguild.command("check-command-permalinks", help=check_command_permalinks_help)
 @click.argument("commands", metavar="[COMMAND]...", nargs=-1)
-def check_command_permalinks(commands):
-    command_help.check_command_permalinks(commands)
+@_command_help_options
+def check_command_permalinks(commands, **opts):
+    command_help.check_command_permalinks(commands, **opts)
 
 
 ###################################################################
@@ -158,8 +265,9 @@ def check_command_permalinks(commands):
 clear_cache_help = """
 Clears the program cache.
 
-Use this command to ensure that command help info is refreshed on
-subsequent commands.
+Cached command help is refreshed automatically when the installed
+version of Guild changes. Use this command to force a refresh of
+cached information.
 
 Either '--all' must be specified or specific '--link-topic',
 '--command', or '--topic-post' options must be specified otherwise the
@@ -197,7 +305,10 @@ command exits with an error.
 @click.option(
     "--cache-info",
     is_flag=True,
-    help="Show cache information and exit. Does not clear anything.",
+    help=(
+        "Show cache information, including hit and miss statistics by key "
+        "namespace, and exit. Does not clear anything."
+    ),
 )
 def clear_cache(
     all=False,
@@ -216,7 +327,7 @@ def clear_cache(
     for link in link_topics or []:
         cache.delete(docs.link_topic_cache_key(link))
     for cmd in commands or []:
-        cache.delete(command_help.cmd_cache_key(cmd))
+        command_help.delete_cmd_cache(cmd)
     for topic_id in topic_posts or []:
         cache.delete(editlib.topic_post_cache_key(topic_id))
 
@@ -300,17 +411,18 @@ def edit(
     diff_cmd=None,
     edit_cmd=None,
 ):
-    editlib.edit(
-        topic,
-        comment=comment,
-        no_comment=no_comment,
-        skip_diff=skip_diff,
-        yes=yes,
-        save_dir=save_dir,
-        force=force,
-        edit_cmd=edit_cmd,
-        diff_cmd=diff_cmd,
-    )
+    with trace.correlation(editlib.topic_trace_id(topic)):
+        editlib.edit(
+            topic,
+            comment=comment,
+            no_comment=no_comment,
+            skip_diff=skip_diff,
+            yes=yes,
+            save_dir=save_dir,
+            force=force,
+            edit_cmd=edit_cmd,
+            diff_cmd=diff_cmd,
+        )
 
 
 ###################################################################
@@ -351,6 +463,17 @@ Fetch a topic.
     is_flag=True,
     help="Stop when an error occurs. Applies only when --docs is used.",
 )
+@click.option(
+    "-j",
+    "--jobs",
+    metavar="N",
+    type=click.IntRange(min=1),
+    default=1,
+    help=(
+        "Number of docs fetched concurrently (default is 1). Applies only "
+        "when --docs is used."
+    ),
+)
 def fetch(
     topic,
     docs=False,
@@ -358,6 +481,7 @@ def fetch(
     force=False,
     save_dir=None,
     stop_on_error=False,
+    jobs=1,
 ):
     if docs:
         editlib.fetch_docs(
@@ -365,10 +489,12 @@ def fetch(
             index_path=index_path,
             force=force,
             stop_on_error=stop_on_error,
+            jobs=jobs,
         )
     else:
         _require_topic(topic)
-        editlib.fetch(topic, save_dir=save_dir, force=force)
+        with trace.correlation(editlib.topic_trace_id(topic)):
+            editlib.fetch(topic, save_dir=save_dir, force=force)
 
 
 ###################################################################
@@ -380,12 +506,27 @@ publish_help = """
 Publish a topic.
 
 To publish all modified topics, use --all.
+
+Use --watch to publish topics when they're saved. With --watch, more
+than one TOPIC may be specified. Each TOPIC is published at start if
+it has local changes.
+
+Use --watch-all to publish any topic in the save directory when it's
+saved. Topics are not published at start with --watch-all.
+
+With --watch and --watch-all, a topic that changed on the server is
+not published. The conflict is reported and other saves continue to
+be published.
 """
 
 
 @myguild.command("publish", help=publish_help)
 @click.argument(
-    "topic", type=int, required=False, shell_complete=_autocomplete_topics
+    "topics",
+    metavar="[TOPIC]...",
+    type=int,
+    nargs=-1,
+    shell_complete=_autocomplete_topics,
 )
 @click.option("-a", "--all", is_flag=True, help="Publish all locally modified topics.")
 @click.option("-m", "--comment", help="Comment used when publishing.")
@@ -402,6 +543,17 @@ To publish all modified topics, use --all.
     is_flag=True,
     help="Stop when an error occurs. Applies only when --all is used.",
 )
+@click.option(
+    "-j",
+    "--jobs",
+    metavar="N",
+    type=click.IntRange(min=1),
+    default=1,
+    help=(
+        "Number of topics published concurrently (default is 1). Applies "
+        "only when --all is used."
+    ),
+)
 @click.option("--diff-cmd", metavar="CMD", help="Command used to diff changes.")
 @click.option("--edit-cmd", metavar="CMD", help="Command used to specify comment.")
 @click.option(
@@ -412,9 +564,29 @@ To publish all modified topics, use --all.
         "'<id>.md' in this directory."
     ),
 )
-@click.option("--watch", is_flag=True, help="Watch a topic and publish when modified.")
+@click.option("--watch", is_flag=True, help="Watch topics and publish when saved.")
+@click.option(
+    "--watch-all",
+    is_flag=True,
+    help="Watch all topics in the save directory and publish when saved.",
+)
+@click.option(
+    "--poll",
+    is_flag=True,
+    help="Poll for saved topics when watching rather than use inotify.",
+)
+@click.option(
+    "--debounce",
+    metavar="SECONDS",
+    type=click.FloatRange(min=0),
+    help=(
+        "Seconds to wait after a topic is saved before publishing it with "
+        "watching (default is %s). Saves made during this time are "
+        "published together." % editlib.DEFAULT_WATCH_DEBOUNCE
+    ),
+)
 def publish(
-    topic,
+    topics,
     all=False,
     comment=None,
     no_comment=False,
@@ -423,11 +595,34 @@ def publish(
     save_dir=None,
     force=False,
     stop_on_error=False,
+    jobs=1,
     diff_cmd=None,
     edit_cmd=None,
     watch=False,
+    watch_all=False,
+    poll=False,
+    debounce=None,
 ):
-    if all:
+    if (watch or watch_all) and all:
+        raise SystemExit("--all cannot be used with --watch or --watch-all")
+    if watch and watch_all:
+        raise SystemExit("--watch and --watch-all cannot both be used")
+    if watch_all and topics:
+        raise SystemExit("TOPIC cannot be used with --watch-all")
+    if watch or watch_all:
+        if watch:
+            _require_topic(topics)
+        try:
+            editlib.watch(
+                topics,
+                save_dir=save_dir,
+                poll=poll,
+                debounce=debounce,
+                all=watch_all,
+            )
+        except KeyboardInterrupt:
+            sys.stdout.write("\n")
+    elif all:
         editlib.publish_all(
             comment=comment,
             no_comment=no_comment,
@@ -438,15 +633,11 @@ def publish(
             save_dir=save_dir,
             edit_cmd=edit_cmd,
             diff_cmd=diff_cmd,
+            jobs=jobs,
         )
     else:
-        _require_topic(topic)
-        if watch:
-            try:
-                editlib.watch(topic, save_dir=save_dir)
-            except KeyboardInterrupt:
-                sys.stdout.write("\n")
-        else:
+        topic = _require_single_topic(topics)
+        with trace.correlation(editlib.topic_trace_id(topic)):
             editlib.publish(
                 topic,
                 comment=comment,
@@ -465,6 +656,13 @@ def _require_topic(topic):
         raise SystemExit("TOPIC is required for this operation.")
 
 
+def _require_single_topic(topics):
+    _require_topic(topics)
+    if len(topics) > 1:
+        raise SystemExit("Only one TOPIC may be specified for this operation.")
+    return topics[0]
+
+
 ###################################################################
 # delete
 ###################################################################
@@ -502,6 +700,10 @@ def delete(topic, yes=False, save_dir=None, force=False):
 
 diff_help = """
 Diff changes to topics.
+
+Diffs are shown using a pager when output is a terminal. To use a
+diff program instead, set DIFF or use --diff-cmd. The program is run
+once for each changed topic.
 """
 
 
@@ -523,31 +725,88 @@ Diff changes to topics.
 @click.option(
     "-D", "--diff-cmd", metavar="CMD", help="Command used when diffing index."
 )
+@click.option(
+    "-j",
+    "--jobs",
+    metavar="N",
+    type=click.IntRange(min=1),
+    help=(
+        "Number of topics read concurrently with --latest when TOPIC is "
+        "omitted (default is %i)." % editlib.DEFAULT_DIFF_LATEST_JOBS
+    ),
+)
 @click.option(
     "-c",
     "--color",
     is_flag=True,
-    help="Always use color when diffing. Ignored if --diff-cmd is used.",
+    help=(
+        "Always use color when diffing. Ignored if --diff-cmd is used or DIFF "
+        "is set."
+    ),
 )
 def diff(
     topic,
     latest=False,
     save_dir=None,
     diff_cmd=None,
+    jobs=None,
     color=False,
 ):
-    if not diff_cmd and color:
-        diff_cmd = "diff -u --color=always"
+    color = True if color else None
+    opts = dict(save_dir=save_dir, diff_cmd=diff_cmd, color=color)
     if not topic:
         if latest:
-            editlib.diff_latest_all(save_dir=save_dir, diff_cmd=diff_cmd)
+            editlib.diff_latest_all(jobs=jobs, **opts)
         else:
-            editlib.diff_base_all(save_dir=save_dir, diff_cmd=diff_cmd)
+            editlib.diff_base_all(**opts)
     else:
         if latest:
-            editlib.diff_latest(topic, save_dir=save_dir, diff_cmd=diff_cmd)
+            with trace.correlation(editlib.topic_trace_id(topic)):
+                editlib.diff_latest(topic, **opts)
         else:
-            editlib.diff_base(topic, save_dir=save_dir, diff_cmd=diff_cmd)
+            editlib.diff_base(topic, **opts)
+
+
+###################################################################
+# status
+###################################################################
+
+
+status_help = """
+Show changed local topics.
+
+Each changed topic is listed with a status code:
+
+\b
+  M  Modified locally
+  C  Modified locally and changed on the server (conflict)
+  ?  Untracked (no base version)
+
+Conflicts are detected using the latest server versions from the last
+fetch. Use 'diff --latest' to get the latest server versions.
+"""
+
+_STATUS_CODES = {
+    editlib.STATUS_MODIFIED: "M",
+    editlib.STATUS_CONFLICT: "C",
+    editlib.STATUS_UNTRACKED: "?",
+}
+
+
+@myguild.command("status", help=status_help)
+@click.option(
+    "--save-dir",
+    metavar="DIR",
+    help=(
+        "Location where topics are saved. Topics are saved as "
+        "'<id>.md' in this directory."
+    ),
+)
+def status(save_dir=None):
+    save_dir = save_dir or editlib.default_save_dir()
+    for topic_id, topic_status in editlib.status(save_dir=save_dir):
+        topic_path = os.path.join(save_dir, "%i.md" % topic_id)
+        print("%s %s" % (_STATUS_CODES[topic_status], os.path.relpath(topic_path)))
 
 
 ###################################################################
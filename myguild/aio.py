@@ -0,0 +1,479 @@
+import asyncio
+import ssl
+import urllib.parse
+import zlib
+
+import pydiscourse
+import requests
+import requests.certs
+import requests.structures
+import requests.utils
+
+from .log_util import get_logger
+
+from . import api as apilib
+from . import util
+
+log = get_logger()
+
+DEFAULT_CONCURRENCY = apilib.DEFAULT_POOL_MAXSIZE
+DEFAULT_TIMEOUT = 30
+
+MAX_REDIRECTS = 30
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Methods that are safe to send again on a new connection when a
+# pooled connection turns out to be closed by the server.
+RETRY_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+DiscourseRateLimitedError = pydiscourse.exceptions.DiscourseRateLimitedError
+DiscourseServerError = pydiscourse.exceptions.DiscourseServerError
+
+
+class AsyncClient(object):
+    """Asyncio client for the Discourse API.
+
+    Requests are sent over HTTP/1.1 connections opened with asyncio
+    streams on the running event loop - no threads are used.
+    Connections are kept alive and reused per host.
+
+    At most `concurrency` requests are in progress at a time.
+    Additional requests wait on a semaphore.
+
+    Requests go through `api.http_request_async` and so share the
+    behavior of the sync client: requests are held while the server
+    rate limits, and are recorded, replayed, and traced.
+
+    The client provides the API calls used by my-guild with the same
+    results and errors as the patched sync client (see `api.init`).
+    `topic2` follows slug redirects and holds topics in memory until a
+    post is created or updated. Post data is sent as a form, so the
+    sync client's 413 workaround for empty JSON bodies isn't needed.
+
+    Use a client in a single event loop and close it when done, or use
+    it as an async context manager.
+    """
+
+    def __init__(
+        self,
+        base_url=None,
+        api_username=None,
+        api_key=None,
+        concurrency=None,
+        timeout=None,
+    ):
+        self.base_url = (base_url or apilib.base_url()).rstrip("/")
+        self.api_username = api_username
+        self.api_key = api_key
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self._pool = _ConnectionPool(self.concurrency)
+        self._topic_memo = util.LRUCache(apilib.TOPIC_MEMO_MAX_ENTRIES)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self._pool.close()
+
+    ### API
+
+    async def get(self, path, override_request_kwargs=None, **params):
+        return await self._api_request(
+            "GET", path, params=params, **(override_request_kwargs or {})
+        )
+
+    async def topic(self, slug, topic_id):
+        return await self.get(f"/t/{slug}/{topic_id}.json")
+
+    async def topic2(self, slug_or_topic_id):
+        """Async version of the sync client's `topic2` (see `api`)."""
+        memo_key = str(slug_or_topic_id)
+        topic = self._topic_memo.get(memo_key)
+        if topic is None:
+            topic = await self.get(
+                f"/t/{slug_or_topic_id}.json",
+                override_request_kwargs={"allow_redirects": True},
+            )
+            self._topic_memo.put(memo_key, topic)
+        return topic
+
+    async def post_by_number(self, topic_id, post_number):
+        return await self.get(f"/posts/by_number/{topic_id}/{post_number}")
+
+    async def update_post(self, post_id, content, edit_reason="", **kwargs):
+        kwargs["post[raw]"] = content
+        kwargs["post[edit_reason]"] = edit_reason
+        try:
+            return await self._api_request("PUT", f"/posts/{post_id}", data=kwargs)
+        finally:
+            self._topic_memo.clear()
+
+    async def create_post(
+        self, content, category_id=None, topic_id=None, title=None, **kwargs
+    ):
+        kwargs.update(
+            category=category_id,
+            title=title,
+            raw=content,
+            topic_id=topic_id,
+        )
+        try:
+            return await self._api_request("POST", "/posts", data=kwargs)
+        finally:
+            self._topic_memo.clear()
+
+    async def public_get_data(self, url):
+        """Async version of `api.public_get_data`."""
+        return apilib.public_response_data(await self.http_request("GET", url), url)
+
+    async def _api_request(self, method, path, allow_redirects=False, **kw):
+        resp = await self.http_request(
+            method,
+            self.base_url + path,
+            headers=self._api_headers(),
+            allow_redirects=allow_redirects,
+            **kw,
+        )
+        return _api_result(resp)
+
+    def _api_headers(self):
+        headers = {"Accept": "application/json; charset=utf-8"}
+        if self.api_key:
+            headers["Api-Key"] = self.api_key
+        if self.api_username:
+            headers["Api-Username"] = self.api_username
+        return headers
+
+    ### HTTP
+
+    async def http_request(self, method, url, **kw):
+        """Sends a request and returns a requests Response.
+
+        Supported keyword args are `params`, `data`, `headers`, and
+        `allow_redirects` (default is True).
+        """
+        async with self._sem:
+            return await apilib.http_request_async(self._send, method, url, **kw)
+
+    async def _send(
+        self, method, url, params=None, data=None, headers=None, allow_redirects=True
+    ):
+        req = _prepare_request(method, url, params, data, headers)
+        history = []
+        while True:
+            resp = await self._send_prepared(req)
+            if not allow_redirects or not _is_redirect(resp):
+                break
+            if len(history) >= MAX_REDIRECTS:
+                raise requests.TooManyRedirects(
+                    "Exceeded %i redirects." % MAX_REDIRECTS, response=resp
+                )
+            history.append(resp)
+            req = _redirect_request(req, resp)
+        resp.history = history
+        return resp
+
+    async def _send_prepared(self, req):
+        origin = _origin(req.url)
+        while True:
+            conn = await self._connect(origin)
+            try:
+                resp, keep_alive = await asyncio.wait_for(
+                    _exchange(conn, req), self.timeout
+                )
+            except asyncio.TimeoutError:
+                conn.close()
+                raise requests.Timeout("%s %s timed out" % (req.method, req.url))
+            except requests.ConnectionError:
+                conn.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                if conn.reused and req.method in RETRY_METHODS:
+                    log.debug("Connection to %s closed - retrying", origin[1])
+                    continue
+                raise requests.ConnectionError(e)
+            if keep_alive:
+                self._pool.release(origin, conn)
+            else:
+                conn.close()
+            resp.url = req.url
+            resp.request = req
+            return resp
+
+    async def _connect(self, origin):
+        try:
+            return await asyncio.wait_for(self._pool.acquire(origin), self.timeout)
+        except asyncio.TimeoutError:
+            raise requests.ConnectTimeout("timed out connecting to %s" % origin[1])
+        except OSError as e:
+            raise requests.ConnectionError(e)
+
+
+def init(concurrency=None):
+    """Returns an async client for the site using API credentials.
+
+    Credentials are read as they are for `api.init`.
+    """
+    api_username, api_key = apilib.credentials()
+    return AsyncClient(
+        api_username=api_username, api_key=api_key, concurrency=concurrency
+    )
+
+
+def _api_result(resp):
+    """Returns decoded JSON for an API response.
+
+    Errors are raised as they are by pydiscourse.
+    """
+    if not resp.ok:
+        msg = _error_msg(resp)
+        if resp.status_code == 429:
+            raise DiscourseRateLimitedError(msg, response=resp)
+        elif 400 <= resp.status_code < 500:
+            raise apilib.DiscourseClientError(msg, response=resp)
+        raise DiscourseServerError(msg, response=resp)
+    if resp.status_code == 302:
+        raise apilib.DiscourseError(
+            "Unexpected Redirect, invalid api key or host?", response=resp
+        )
+    content_type = resp.headers.get("content-type", "")
+    if "application/json" not in content_type:
+        if not resp.content.strip():
+            return None
+        raise apilib.DiscourseError(
+            "Invalid Response, expecting JSON got \"%s\"" % content_type,
+            response=resp,
+        )
+    try:
+        decoded = resp.json()
+    except ValueError as e:
+        raise apilib.DiscourseError("failed to decode response", response=resp) from e
+    if isinstance(decoded, dict) and decoded.get("errors"):
+        raise apilib.DiscourseError(
+            decoded.get("message") or ",".join(decoded["errors"]), response=resp
+        )
+    return decoded
+
+
+def _error_msg(resp):
+    try:
+        return ",".join(resp.json()["errors"])
+    except (ValueError, TypeError, KeyError):
+        return resp.reason or "%s: %s" % (resp.status_code, resp.text)
+
+
+###################################################################
+# HTTP/1.1
+###################################################################
+
+
+def _prepare_request(method, url, params, data, headers):
+    req_headers = requests.utils.default_headers()
+    req_headers.update(headers or {})
+    return requests.Request(
+        method, url, params=params, data=data, headers=req_headers
+    ).prepare()
+
+
+def _is_redirect(resp):
+    return resp.status_code in REDIRECT_STATUSES and "location" in resp.headers
+
+
+def _redirect_request(req, resp):
+    url = urllib.parse.urljoin(req.url, resp.headers["location"])
+    method = req.method
+    if resp.status_code == 303 and method != "HEAD":
+        method = "GET"
+    elif resp.status_code in (301, 302) and method == "POST":
+        method = "GET"
+    if _origin(url) == _origin(req.url):
+        headers = requests.structures.CaseInsensitiveDict(req.headers)
+    else:
+        # Don't send API credentials to another host.
+        headers = requests.utils.default_headers()
+    body = req.body if method == req.method else None
+    if body is None:
+        headers.pop("Content-Type", None)
+        headers.pop("Content-Length", None)
+    redirect = requests.PreparedRequest()
+    redirect.prepare(method=method, url=url, headers=headers, data=body)
+    return redirect
+
+
+def _origin(url):
+    parts = urllib.parse.urlsplit(url)
+    default_port = 443 if parts.scheme == "https" else 80
+    return parts.scheme, parts.hostname, parts.port or default_port
+
+
+async def _exchange(conn, req):
+    """Sends req on conn and reads the response.
+
+    Returns a tuple of requests Response and a flag indicating whether
+    conn can be used for another request.
+    """
+    conn.writer.write(_request_bytes(req))
+    await conn.writer.drain()
+    status, reason, headers = await _read_response_head(conn.reader)
+    while 100 <= status < 200:
+        status, reason, headers = await _read_response_head(conn.reader)
+    body, keep_alive = await _read_response_body(conn.reader, req, status, headers)
+    resp = requests.Response()
+    resp.status_code = status
+    resp.reason = reason
+    resp.headers = headers
+    resp.encoding = requests.utils.get_encoding_from_headers(headers)
+    resp._content = _decode_content(body, headers)
+    return resp, keep_alive and headers.get("connection", "").lower() != "close"
+
+
+def _request_bytes(req):
+    parts = urllib.parse.urlsplit(req.url)
+    target = parts.path or "/"
+    if parts.query:
+        target += "?" + parts.query
+    host = parts.hostname
+    if parts.port:
+        host += ":%i" % parts.port
+    lines = ["%s %s HTTP/1.1" % (req.method, target), "Host: %s" % host]
+    lines.extend("%s: %s" % (name, val) for name, val in req.headers.items())
+    body = req.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if body and "content-length" not in req.headers:
+        lines.append("Content-Length: %i" % len(body))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+async def _read_response_head(reader):
+    status_line = (await _read_line(reader)).decode("latin-1")
+    try:
+        _version, status, reason = (status_line.split(" ", 2) + [""])[:3]
+        status = int(status)
+    except ValueError:
+        raise requests.ConnectionError("invalid status line: %r" % status_line)
+    headers = requests.structures.CaseInsensitiveDict()
+    while True:
+        line = (await _read_line(reader)).decode("latin-1")
+        if not line:
+            break
+        name, _, val = line.partition(":")
+        name, val = name.strip(), val.strip()
+        headers[name] = "%s, %s" % (headers[name], val) if name in headers else val
+    return status, reason.strip(), headers
+
+
+async def _read_line(reader):
+    line = await reader.readline()
+    if not line.endswith(b"\n"):
+        raise asyncio.IncompleteReadError(line, None)
+    return line.rstrip(b"\r\n")
+
+
+async def _read_response_body(reader, req, status, headers):
+    if req.method == "HEAD" or status in (204, 304):
+        return b"", True
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        return await _read_chunked(reader), True
+    length = headers.get("content-length")
+    if length is not None:
+        return await reader.readexactly(int(length)), True
+    # Body is delimited by the server closing the connection.
+    return await reader.read(), False
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        size_line = await _read_line(reader)
+        try:
+            size = int(size_line.split(b";", 1)[0], 16)
+        except ValueError:
+            raise requests.ConnectionError("invalid chunk size: %r" % size_line)
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+    while await _read_line(reader):
+        pass
+    return b"".join(chunks)
+
+
+def _decode_content(body, headers):
+    encoding = headers.get("content-encoding", "").lower()
+    if body and encoding in ("gzip", "deflate"):
+        # wbits of 32 + MAX_WBITS accepts both gzip and zlib headers.
+        return zlib.decompress(body, 32 + zlib.MAX_WBITS)
+    return body
+
+
+###################################################################
+# Connection pool
+###################################################################
+
+
+class _Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def closed(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+class _ConnectionPool(object):
+    """Keeps up to `maxsize` idle connections per origin for reuse."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._ssl = None
+
+    async def acquire(self, origin):
+        idle = self._idle.get(origin) or []
+        while idle:
+            conn = idle.pop()
+            if not conn.closed():
+                conn.reused = True
+                return conn
+            conn.close()
+        return await self._open(origin)
+
+    async def _open(self, origin):
+        scheme, host, port = origin
+        ssl_context = self._ssl_context() if scheme == "https" else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+        return _Connection(reader, writer)
+
+    def _ssl_context(self):
+        if self._ssl is None:
+            self._ssl = ssl.create_default_context(cafile=requests.certs.where())
+        return self._ssl
+
+    def release(self, origin, conn):
+        idle = self._idle.setdefault(origin, [])
+        if len(idle) < self.maxsize:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    async def close(self):
+        conns = [conn for idle in self._idle.values() for conn in idle]
+        self._idle.clear()
+        for conn in conns:
+            conn.close()
+        for conn in conns:
+            try:
+                await conn.writer.wait_closed()
+            except OSError:
+                pass
@@ -1,19 +1,98 @@
+import asyncio
+import email.utils
+import functools
 import json
 import os
+import re
+import threading
+import time
 import types
+import urllib.parse
 
 import pydiscourse
+import pydiscourse.client
 import requests
+import requests.adapters
+import requests.structures
+
+from .log_util import get_logger
+
+from . import cache
+from . import recording
+from . import trace
+from . import util
+
+log = get_logger()
 
 DiscourseClientError = pydiscourse.exceptions.DiscourseClientError
 DiscourseError = pydiscourse.exceptions.DiscourseError
 
+DEFAULT_BASE_URL = "https://my.guild.ai"
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+
+TOPIC_MEMO_MAX_ENTRIES = 256
+
+RATE_LIMIT_RETRIES = 5
+DEFAULT_RATE_LIMIT_WAIT = 10.0
+
+_session = None
+_session_config = {}
+_session_lock = threading.Lock()
+
+_client = None
+_client_lock = threading.Lock()
+
+_base_url = None
+
 
 def init():
-    api_key = _my_guild_env("MY_GUILD_API_KEY")
-    api_username = _my_guild_env("MY_GUILD_API_USER")
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = _init_client()
+        return _client
+
+
+def base_url():
+    """Returns the base URL of the Discourse site.
+
+    Set using `set_base_url` or `MY_GUILD_URL`. Defaults to
+    `DEFAULT_BASE_URL`.
+    """
+    return (_base_url or os.getenv("MY_GUILD_URL") or DEFAULT_BASE_URL).rstrip("/")
+
+
+def set_base_url(url):
+    """Sets the base URL of the Discourse site.
+
+    The API client is re-initialized on next use. The cache for the
+    site is used (see `cache.set_site`).
+    """
+    global _base_url, _client
+    with _client_lock:
+        _base_url = url
+        _client = None
+    cache.set_site(_cache_site(base_url()))
+
+
+def _cache_site(url):
+    if url == DEFAULT_BASE_URL:
+        return None
+    parts = urllib.parse.urlsplit(url)
+    return re.sub(r"[^\w.-]+", "_", (parts.netloc + parts.path).strip("/"))
+
+
+def site_url(path):
+    """Returns the site URL for path."""
+    return "%s/%s" % (base_url(), path.lstrip("/"))
+
+
+def _init_client():
+    api_username, api_key = credentials()
     client = pydiscourse.DiscourseClient(
-        "https://my.guild.ai",
+        base_url(),
         api_username=api_username,
         api_key=api_key,
     )
@@ -21,7 +100,15 @@ def init():
     return client
 
 
+def credentials():
+    """Returns a tuple of API user and API key from the environment."""
+    return _my_guild_env("MY_GUILD_API_USER"), _my_guild_env("MY_GUILD_API_KEY")
+
+
 def _my_guild_env(name):
+    if recording.replaying():
+        # Replayed requests aren't sent - credentials aren't needed.
+        return os.getenv(name) or "replay"
     try:
         return os.environ[name]
     except KeyError:
@@ -34,6 +121,7 @@ def _my_guild_env(name):
 def _patch_client(client):
     _fix_413_errors(client)
     _add_topic2_function(client)
+    _forget_topics_on_change(client)
 
 
 def _fix_413_errors(client):
@@ -50,6 +138,7 @@ def _fix_413_errors(client):
 
 
 def _add_topic2_function(client):
+    client._topic_memo = util.LRUCache(TOPIC_MEMO_MAX_ENTRIES)
     client.topic2 = types.MethodType(_topic2, client)
 
 
@@ -59,14 +148,398 @@ def _topic2(api, slug_or_topic_id):
     slug_or_topic_id may be either a slug or a topic ID. If it's a
     slug, handles the redirect from the server to te fully formed
     topic URL.
+
+    Topics are held in memory for the life of the client and shared
+    across calls. Callers must not modify them.
+    """
+    memo_key = str(slug_or_topic_id)
+    topic = api._topic_memo.get(memo_key)
+    if topic is None:
+        topic = api._get(
+            f"/t/{slug_or_topic_id}.json",
+            override_request_kwargs={"allow_redirects": True},
+        )
+        api._topic_memo.put(memo_key, topic)
+    return topic
+
+
+def _forget_topics_on_change(client):
+    # Topics held by topic2 may be out-of-date once a post changes.
+    for name in ("create_post", "update_post"):
+        setattr(client, name, _forget_topics_wrapper(client, getattr(client, name)))
+
+
+def _forget_topics_wrapper(client, f):
+    def wrapper(*args, **kw):
+        try:
+            return f(*args, **kw)
+        finally:
+            client._topic_memo.clear()
+
+    return wrapper
+
+
+###################################################################
+# Shared HTTP session
+###################################################################
+
+
+def configure_session(pool_connections=None, pool_maxsize=None, pool_block=None):
+    """Configures the shared HTTP session.
+
+    `pool_connections` is the number of per-host connection pools
+    kept. `pool_maxsize` is the maximum number of connections kept per
+    host. If `pool_block` is true, requests wait for a free connection
+    rather than opening connections beyond `pool_maxsize`.
+
+    Unspecified values are read from the environment
+    (`MY_GUILD_POOL_CONNECTIONS`, `MY_GUILD_POOL_MAXSIZE`,
+    `MY_GUILD_POOL_BLOCK`) or use defaults. Any existing session is
+    closed and replaced on next use.
+    """
+    global _session
+    with _session_lock:
+        _session_config.update(
+            {
+                name: val
+                for name, val in [
+                    ("pool_connections", pool_connections),
+                    ("pool_maxsize", pool_maxsize),
+                    ("pool_block", pool_block),
+                ]
+                if val is not None
+            }
+        )
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def ensure_pool_maxsize(size):
+    """Ensures the shared session keeps at least `size` connections.
+
+    Used by commands that make up to `size` concurrent requests so
+    that connections beyond the configured pool size are kept alive.
+    """
+    pool_maxsize = _session_opt(
+        "pool_maxsize", "MY_GUILD_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE
+    )
+    if size > pool_maxsize:
+        log.debug("Increasing HTTP connection pool size to %i", size)
+        configure_session(pool_maxsize=size)
+
+
+def session():
+    """Returns the shared HTTP session used for all site requests.
+
+    The session keeps connections alive and pools them per host so
+    that successive requests avoid new TCP and TLS handshakes.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _init_session()
+        return _session
+
+
+def _init_session():
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=_session_opt(
+            "pool_connections", "MY_GUILD_POOL_CONNECTIONS", DEFAULT_POOL_CONNECTIONS
+        ),
+        pool_maxsize=_session_opt(
+            "pool_maxsize", "MY_GUILD_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE
+        ),
+        pool_block=bool(_session_opt("pool_block", "MY_GUILD_POOL_BLOCK", 0)),
+    )
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def _session_opt(name, env_name, default):
+    try:
+        return _session_config[name]
+    except KeyError:
+        pass
+    env_val = os.getenv(env_name)
+    if not env_val:
+        return default
+    try:
+        return int(env_val)
+    except ValueError:
+        raise SystemExit(f"invalid value for {env_name}: {env_val!r}")
+
+
+def http_request(method, url, **kw):
+    """Sends a request using the shared session.
+
+    If the server responds with 429 (Too Many Requests), all requests
+    made by the process wait for the period specified by the server
+    before the request is retried. The last response is returned if
+    the server continues to rate limit the request after
+    `RATE_LIMIT_RETRIES` retries.
+
+    When recording or replaying (see `recording`), the final response
+    is recorded or is served from a recording without being sent.
+
+    When tracing (see `trace`), an 'http' event is written for the
+    final response.
+    """
+    t0 = time.time()
+    retries = []
+    resp = recording.http_request(
+        functools.partial(_send_request, retries), method, url, kw
+    )
+    _trace_http(method, url, kw, resp, t0, retries)
+    return resp
+
+
+async def http_request_async(send, method, url, **kw):
+    """Async version of `http_request`.
+
+    `send` is a coroutine function that sends a single request and
+    returns a requests Response (see `aio.AsyncClient`). Rate limits,
+    recording, and tracing are handled as they are for `http_request`.
     """
-    return api._get(
-        f"/t/{slug_or_topic_id}.json", override_request_kwargs={"allow_redirects": True}
+    t0 = time.time()
+    retries = []
+    resp = await recording.http_request_async(
+        functools.partial(_send_request_async, send, retries), method, url, kw
     )
+    _trace_http(method, url, kw, resp, t0, retries)
+    return resp
+
+
+def _trace_http(method, url, kw, resp, t0, retries):
+    trace.event(
+        "http",
+        method=method,
+        url=url,
+        params=kw.get("params"),
+        status=resp.status_code,
+        seconds=trace.elapsed(t0),
+        bytes=len(resp.content),
+        redirects=len(resp.history),
+        retries=len(retries),
+    )
+
+
+def _send_request(retries, method, url, **kw):
+    while True:
+        _rate_limit.wait()
+        resp = session().request(method, url, **kw)
+        if not _retry_rate_limited(resp, retries, method, url):
+            return resp
+
+
+async def _send_request_async(send, retries, method, url, **kw):
+    while True:
+        await _rate_limit.wait_async()
+        resp = await send(method, url, **kw)
+        if not _retry_rate_limited(resp, retries, method, url):
+            return resp
+
+
+def _retry_rate_limited(resp, retries, method, url):
+    """Pauses requests and returns True if resp should be retried.
+
+    Returns False if resp isn't rate limited or if the request was
+    already retried `RATE_LIMIT_RETRIES` times.
+    """
+    if resp.status_code != 429 or len(retries) >= RATE_LIMIT_RETRIES:
+        return False
+    wait = _rate_limit_wait(resp)
+    retries.append(wait)
+    log.info(
+        "Rate limited by server (%s %s) - pausing requests for %0.1f seconds",
+        method,
+        url,
+        wait,
+    )
+    _rate_limit.pause(wait)
+    return True
+
+
+def http_get(url, **kw):
+    return http_request("GET", url, **kw)
+
+
+def _rate_limit_wait(resp):
+    return (
+        _retry_after_header_wait(resp)
+        or _discourse_wait_seconds(resp)
+        or DEFAULT_RATE_LIMIT_WAIT
+    )
+
+
+def _retry_after_header_wait(resp):
+    val = resp.headers.get("retry-after")
+    if not val:
+        return None
+    try:
+        return max(float(val), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(val)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_time.timestamp() - time.time(), 0.0)
+
+
+def _discourse_wait_seconds(resp):
+    if "application/json" not in resp.headers.get("content-type", ""):
+        return None
+    try:
+        return float(resp.json()["extras"]["wait_seconds"])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+class _RateLimitGate(object):
+    """Holds all requests while the server rate limits.
+
+    Applies to requests made by threads and by async clients.
+    """
+
+    def __init__(self):
+        self._resume_time = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._resume_time = max(self._resume_time, time.time() + seconds)
+
+    def wait(self):
+        while True:
+            delay = self._delay()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+
+    async def wait_async(self):
+        while True:
+            delay = self._delay()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+    def _delay(self):
+        with self._lock:
+            return self._resume_time - time.time()
+
+
+_rate_limit = _RateLimitGate()
+
+
+class _ClientTransport(object):
+    """Stands in for the `requests` module used by pydiscourse.
+
+    pydiscourse calls `requests.request` for each API call. Routing
+    those calls through `http_request` lets the client share the pooled
+    session.
+    """
+
+    request = staticmethod(http_request)
+
+
+pydiscourse.client.requests = _ClientTransport()
+
+
+###################################################################
+# HTTP response cache
+###################################################################
+
+
+def http_cache_key(url):
+    return "http:%s" % url
+
+
+def conditional_get(url, **kw):
+    """GET url, revalidating a cached response when available.
+
+    200 responses with an ETag or Last-Modified header are cached
+    along with their validators. When a cached response exists, the
+    request is conditional. If the server responds with 304 (Not
+    Modified), the cached response is returned. Returns a requests
+    Response.
+
+    Each cached response is a full copy of the body. Use only for
+    small responses that are read again after their derived cache
+    entries expire - currently link topic JSON (see
+    `docs.get_link_topic_json`).
+    """
+    cache_key = http_cache_key(url)
+    cached = cache.read_json(cache_key)
+    headers = dict(kw.pop("headers", None) or {})
+    if cached:
+        headers.update(_conditional_headers(cached))
+    resp = http_get(url, headers=headers, **kw)
+    if resp.status_code == 304 and cached:
+        log.debug("Cached response for %s is current", url)
+        return _cached_response(cached, url)
+    if resp.status_code == 200 and _response_validators(resp):
+        cache.write(cache_key, json.dumps(_encode_response(resp)))
+    elif cached:
+        cache.delete(cache_key)
+    return resp
+
+
+def _conditional_headers(cached):
+    headers = {}
+    validators = cached.get("validators") or {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last-modified" in validators:
+        headers["If-Modified-Since"] = validators["last-modified"]
+    return headers
+
+
+def _response_validators(resp):
+    return {
+        name: resp.headers[name]
+        for name in ("etag", "last-modified")
+        if resp.headers.get(name)
+    }
+
+
+def _encode_response(resp):
+    return {
+        "status": resp.status_code,
+        "reason": resp.reason,
+        "headers": {
+            name: resp.headers[name]
+            for name in ("content-type", "location")
+            if name in resp.headers
+        },
+        "validators": _response_validators(resp),
+        "body": resp.content.decode("utf-8"),
+    }
+
+
+def _cached_response(cached, url):
+    resp = requests.Response()
+    resp.status_code = cached["status"]
+    resp.reason = cached.get("reason")
+    resp.headers = requests.structures.CaseInsensitiveDict(cached["headers"])
+    resp.headers.update(cached.get("validators") or {})
+    resp.url = url
+    resp.encoding = "utf-8"
+    resp._content = cached["body"].encode("utf-8")
+    return resp
 
 
 def public_get_data(url):
-    resp = requests.get(url)
+    return public_response_data(http_get(url), url)
+
+
+def public_response_data(resp, url):
+    """Returns the decoded JSON of a response to a public GET of url.
+
+    Raises DiscourseClientError if the response is an error.
+    """
     if not resp.ok:
         if resp.status_code == 404:
             raise DiscourseClientError("not found: %s" % url)
@@ -0,0 +1,249 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import yaml
+
+from .log_util import get_logger
+
+from . import fake_discourse
+
+log = get_logger()
+
+DEFAULT_SIZES = "100,1000,10000"
+
+SCENARIOS = [
+    "fetch-docs",
+    "publish-all",
+    "publish-docs-index",
+    "publish-commands",
+]
+
+
+class Workspace(object):
+    """Files and environment used to run my-guild against a fake site."""
+
+    def __init__(self, root, fake):
+        self.root = root
+        self.fake = fake
+        self.save_dir = os.path.join(root, "topics")
+        self.index_path = os.path.join(root, "docs-index.yml")
+        os.makedirs(self.save_dir)
+
+    def cache_dir(self, name):
+        return os.path.join(self.root, "cache-%s" % name)
+
+    def env(self, cache_name):
+        env = dict(os.environ)
+        env.update(
+            {
+                "MY_GUILD_URL": self.fake.url,
+                "MY_GUILD_API_KEY": "bench",
+                "MY_GUILD_API_USER": "bench",
+                "MY_GUILD_CACHE_DIR": self.cache_dir(cache_name),
+                "NO_PROXY": "*",
+            }
+        )
+        env.pop("DIFF", None)
+        return env
+
+
+def run_scenario(name, ws, jobs):
+    """Runs a scenario and returns (exit_code, seconds, server_stats).
+
+    Setup steps are not timed and their requests are not counted.
+    """
+    setup, args, cache_name = _scenario(name, ws, jobs)
+    if setup:
+        setup()
+    ws.fake.reset_stats()
+    cmd = [sys.executable, "-m", "myguild"] + args
+    log.debug("running %s", cmd)
+    t0 = time.time()
+    p = subprocess.run(
+        cmd,
+        env=ws.env(cache_name),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    seconds = time.time() - t0
+    if p.returncode != 0:
+        log.warning(
+            "%s exited with %i: %s",
+            name,
+            p.returncode,
+            p.stderr.decode(errors="replace").strip()[-500:],
+        )
+    return p.returncode, seconds, ws.fake.stats()
+
+
+def _scenario(name, ws, jobs):
+    jobs_args = ["-j", str(jobs)]
+    if name == "fetch-docs":
+        args = ["fetch", "--docs", "-i", ws.index_path, "--save-dir", ws.save_dir]
+        return None, args + jobs_args, "fetch"
+    elif name == "publish-all":
+        args = ["publish", "--all", "-y", "-n", "--save-dir", ws.save_dir]
+        return lambda: _modify_topics(ws), args + jobs_args, "fetch"
+    elif name == "publish-docs-index":
+        return None, ["publish-docs-index", "--check", "-i", ws.index_path], "index"
+    elif name == "publish-commands":
+        return None, ["publish-commands", "--check"] + jobs_args, "commands"
+    else:
+        raise ValueError(name)
+
+
+def _modify_topics(ws):
+    for name in os.listdir(ws.save_dir):
+        if name.endswith(".md"):
+            with open(os.path.join(ws.save_dir, name), "a") as f:
+                f.write("Edited by bench.\n")
+
+
+def _write_index(path, links):
+    index = [{"section": "Bench", "links": links}]
+    with open(path, "w") as f:
+        yaml.safe_dump(index, f)
+
+
+def _add_command_topics(ws):
+    """Adds a help topic for each Guild command to the Commands category.
+
+    Command help is read using the workspace setup cache so that the
+    user cache isn't modified and scenarios start with empty caches.
+
+    Returns False if Guild commands cannot be read.
+    """
+    from . import cache
+    from . import command_help
+
+    fake = ws.fake
+    user_cache_dir = cache.cache_dir
+    cache.set_cache_dir(ws.cache_dir("setup"))
+    try:
+        commands = command_help._guild_commands()
+    except SystemExit as e:
+        log.warning("Cannot read Guild commands (%s)", e)
+        return False
+    finally:
+        cache.flush_usage()
+        cache.set_cache_dir(user_cache_dir)
+    category_id = fake.topic_for_slug("guild-ai-commands")["category_id"]
+    for cmd, _data in commands:
+        fake.add_topic(
+            command_help._command_help_title(cmd),
+            "Help for %s" % cmd,
+            slug=command_help._command_help_slug(cmd),
+            category_id=category_id,
+            permalink=command_help._command_permalink(cmd),
+        )
+    return True
+
+
+def _format_size(n):
+    for suffix in ("B", "K", "M"):
+        if n < 1024:
+            return "%i%s" % (n, suffix)
+        n /= 1024.0
+    return "%0.1fG" % n
+
+
+@click.command()
+@click.option(
+    "-s",
+    "--sizes",
+    default=DEFAULT_SIZES,
+    help="Comma separated numbers of synthetic topics (default is %s)." % DEFAULT_SIZES,
+)
+@click.option(
+    "scenarios",
+    "-r",
+    "--run",
+    type=click.Choice(SCENARIOS),
+    multiple=True,
+    help="Scenario to run. May be used multiple times. Default is all.",
+)
+@click.option(
+    "-j", "--jobs", type=int, default=8, help="Jobs used by my-guild (default is 8)."
+)
+@click.option("--latency", type=float, default=0.0, help="Seconds added per request.")
+@click.option(
+    "--rate-limit-every",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Respond to every Nth request with 429.",
+)
+@click.option("--keep", is_flag=True, help="Keep the bench workspace.")
+@click.option("--debug", is_flag=True, help="Enable debug logging.")
+def main(sizes, scenarios, jobs, latency, rate_limit_every, keep, debug):
+    """Time my-guild commands against a local fake Discourse site.
+
+    For each size, a fake site is populated with that many docs
+    topics and each scenario is run as a separate my-guild process.
+    Reports wall time and the requests and bytes seen by the site
+    ('sent' is bytes sent by the site).
+    """
+    from . import log_util
+
+    log_util.init(debug)
+    if not debug:
+        # Only show problems - setup logs progress for each command.
+        logging.getLogger().setLevel(logging.WARNING)
+    scenarios = scenarios or SCENARIOS
+    print(
+        "%-20s %7s %9s %9s %9s %9s %5s %4s"
+        % (
+            "scenario",
+            "topics",
+            "seconds",
+            "requests",
+            "sent",
+            "received",
+            "429s",
+            "exit",
+        )
+    )
+    for size in [int(s) for s in sizes.split(",") if s.strip()]:
+        root = tempfile.mkdtemp(prefix="myguild-bench-")
+        fake = fake_discourse.FakeDiscourse(
+            latency=latency, rate_limit_every=rate_limit_every
+        ).start()
+        try:
+            ws = Workspace(root, fake)
+            _write_index(ws.index_path, fake_discourse.populate(fake, size))
+            has_commands = "publish-commands" in scenarios and _add_command_topics(ws)
+            for name in scenarios:
+                if name == "publish-commands" and not has_commands:
+                    continue
+                exit_code, seconds, stats = run_scenario(name, ws, jobs)
+                print(
+                    "%-20s %7i %9.2f %9i %9s %9s %5i %4i"
+                    % (
+                        name,
+                        size,
+                        seconds,
+                        stats.get("requests", 0),
+                        _format_size(stats.get("bytes-sent", 0)),
+                        _format_size(stats.get("bytes-received", 0)),
+                        stats.get("rate-limited", 0),
+                        exit_code,
+                    )
+                )
+                sys.stdout.flush()
+        finally:
+            fake.stop()
+            if keep:
+                print("Workspace for %i topics: %s" % (size, root), file=sys.stderr)
+            else:
+                shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
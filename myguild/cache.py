@@ -1,57 +1,987 @@
+import atexit
+import contextlib
 import errno
+import fcntl
 import hashlib
+import json
 import os
-import shutil
+import re
+import sqlite3
+import threading
+import time
 
 from .log_util import get_logger
 
+from . import trace
 from . import util
 
 log = get_logger()
 
-cache_dir = os.path.abspath(os.path.expanduser("~/.cache/myguild"))
+DEFAULT_CACHE_DIR = "~/.cache/myguild"
+
+cache_dir = os.path.abspath(
+    os.path.expanduser(os.getenv("MY_GUILD_CACHE_DIR") or DEFAULT_CACHE_DIR)
+)
+
+DEFAULT_BACKEND = "sqlite"
+
+SQLITE_DB_NAME = "cache.db"
+SQLITE_MAX_VARS = 500
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# In-memory tier in front of the backend. `_memo` holds values by key
+# and `_parsed_memo` holds parsed values by key and parse function.
+MEMO_MAX_ENTRIES = 4096
+
+_memo = util.LRUCache(MEMO_MAX_ENTRIES)
+_parsed_memo = util.LRUCache(MEMO_MAX_ENTRIES)
+
+
+###################################################################
+# Backends
+###################################################################
+
+
+class Entry(object):
+    """Cache entry value and metadata.
+
+    `created` and `accessed` are timestamps. `size` is the size of the
+    value in bytes.
+    """
+
+    def __init__(self, value, created, accessed, size):
+        self.value = value
+        self.created = created
+        self.accessed = accessed
+        self.size = size
+
+
+class Backend(object):
+    """Interface for cache storage.
+
+    Keys and values are strings. `read` returns an `Entry` or None for
+    missing keys and records the access time of the entry.
+    """
+
+    name = None
+
+    def read(self, key):
+        raise NotImplementedError()
+
+    def write(self, key, value):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def read_many(self, keys):
+        """Returns a dict of key to `Entry` for keys that exist."""
+        entries = {}
+        for key in keys:
+            entry = self.read(key)
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    def write_many(self, items):
+        for key, value in items:
+            self.write(key, value)
+
+    def iter_keys(self, prefix=""):
+        raise NotImplementedError()
+
+    def iter_entries(self, prefix=""):
+        """Generates tuples of key and `Entry` without values.
+
+        Entry values are None.
+        """
+        raise NotImplementedError()
+
+    def stats(self):
+        raise NotImplementedError()
+
+    def read_usage(self):
+        """Returns persisted usage by namespace.
+
+        Usage is a dict of namespace to a dict of counters (see
+        `USAGE_COUNTERS`).
+        """
+        raise NotImplementedError()
+
+    def add_usage(self, usage):
+        """Adds usage counters by namespace to persisted usage."""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class DirBackend(Backend):
+    """Stores each entry as a file in a directory.
+
+    Entry files are named using the SHA-1 digest of their key. The key
+    is saved alongside the entry in a file with a '.key' extension so
+    that keys can be listed. Entry metadata is read from the entry
+    file status: modified time is the created time and access time is
+    set explicitly on read.
+    """
+
+    name = "dir"
+
+    def __init__(self, dir):
+        self.dir = dir
+
+    def read(self, key):
+        path = self._key_path(key)
+        try:
+            value = open(path, encoding="utf-8").read()
+            st = os.stat(path)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        accessed = time.time()
+        _touch_atime(path, accessed, st.st_mtime)
+        return Entry(value, st.st_mtime, accessed, st.st_size)
+
+    def _key_path(self, key):
+        encoded_key = key.encode("utf-8")
+        digest = hashlib.sha1(encoded_key).hexdigest()
+        return os.path.join(self.dir, digest)
+
+    def write(self, key, value):
+        path = self._key_path(key)
+        util.ensure_dir(os.path.dirname(path))
+        util.write_atomic(path, value)
+        util.write_atomic(path + ".key", key)
+
+    def delete(self, key):
+        path = self._key_path(key)
+        util.ensure_deleted(path)
+        util.ensure_deleted(path + ".key")
+
+    def iter_keys(self, prefix=""):
+        for key, _path in self._iter_key_paths(prefix):
+            yield key
+
+    def _iter_key_paths(self, prefix):
+        for name in self._list_dir():
+            if not name.endswith(".key"):
+                continue
+            key_path = os.path.join(self.dir, name)
+            try:
+                key = open(key_path).read()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                if key.startswith(prefix):
+                    yield key, key_path[:-4]
+
+    def iter_entries(self, prefix=""):
+        for key, path in self._iter_key_paths(prefix):
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                yield key, Entry(None, st.st_mtime, st.st_atime, st.st_size)
+
+    def _list_dir(self):
+        try:
+            return os.listdir(self.dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def stats(self):
+        names = [
+            name
+            for name in self._list_dir()
+            if len(name) == 40 and not name.endswith(".key")
+        ]
+        return {
+            "entries": len(names),
+            "size": sum(_file_size(os.path.join(self.dir, name)) for name in names),
+        }
+
+    def read_usage(self):
+        try:
+            return json.load(open(self._usage_path()))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        except ValueError:
+            log.warning("Invalid cache usage in %s - ignoring", self._usage_path())
+            return {}
+
+    def _usage_path(self):
+        return os.path.join(self.dir, "usage.json")
+
+    def add_usage(self, usage):
+        with locked("usage"):
+            merged = self.read_usage()
+            for namespace, counters in usage.items():
+                ns_merged = merged.setdefault(namespace, {})
+                for name, val in counters.items():
+                    ns_merged[name] = ns_merged.get(name, 0) + val
+            util.write_atomic(self._usage_path(), json.dumps(merged))
+
+
+def _touch_atime(path, atime, mtime):
+    try:
+        os.utime(path, (atime, mtime))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class SQLiteBackend(Backend):
+    """Stores entries in a single SQLite database.
+
+    The database uses write-ahead logging so that readers don't block
+    writers. Each thread uses its own connection.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._init_conn_with_recovery()
+        return conn
+
+    def _init_conn_with_recovery(self):
+        try:
+            return self._init_conn()
+        except sqlite3.DatabaseError as e:
+            if isinstance(e, sqlite3.OperationalError):
+                raise
+            corrupt_path = "%s.corrupt-%i" % (self.path, time.time())
+            log.warning(
+                "Cache database %s is corrupt (%s) - moving to %s and "
+                "starting with an empty cache",
+                self.path,
+                e,
+                corrupt_path,
+            )
+            with locked("sqlite-recovery"):
+                if os.path.exists(self.path):
+                    os.rename(self.path, corrupt_path)
+                for ext in ("-wal", "-shm"):
+                    util.ensure_deleted(self.path + ext)
+            return self._init_conn()
+
+    def _init_conn(self):
+        util.ensure_dir(os.path.dirname(self.path))
+        conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL"
+            ")"
+        )
+        added = _ensure_sqlite_columns(
+            conn,
+            "entries",
+            [
+                ("created", "REAL NOT NULL DEFAULT 0"),
+                ("accessed", "REAL NOT NULL DEFAULT 0"),
+                ("size", "INTEGER NOT NULL DEFAULT 0"),
+            ],
+        )
+        if added:
+            # Entries written before metadata was stored are treated as
+            # new.
+            now = time.time()
+            conn.execute(
+                "UPDATE entries SET created = ?, accessed = ?, size = LENGTH(value)",
+                (now, now),
+            )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " namespace TEXT NOT NULL,"
+            " counter TEXT NOT NULL,"
+            " value REAL NOT NULL,"
+            " PRIMARY KEY (namespace, counter)"
+            ")"
+        )
+        conn.commit()
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    def read(self, key):
+        return self.read_many([key]).get(key)
+
+    def write(self, key, value):
+        self.write_many([(key, value)])
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def read_many(self, keys):
+        keys = list(keys)
+        conn = self._conn()
+        entries = {}
+        for i in range(0, len(keys), SQLITE_MAX_VARS):
+            chunk = keys[i : i + SQLITE_MAX_VARS]
+            sql = (
+                "SELECT key, value, created, accessed, size FROM entries "
+                "WHERE key IN (%s)" % ",".join("?" * len(chunk))
+            )
+            for key, value, created, accessed, size in conn.execute(sql, chunk):
+                entries[key] = Entry(value, created, accessed, size)
+        if entries:
+            accessed = time.time()
+            with conn:
+                conn.executemany(
+                    "UPDATE entries SET accessed = ? WHERE key = ?",
+                    [(accessed, key) for key in entries],
+                )
+        return entries
+
+    def write_many(self, items):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, created, accessed, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (key, value, now, now, len(value.encode("utf-8")))
+                    for key, value in items
+                ],
+            )
+
+    def iter_keys(self, prefix=""):
+        cursor = self._conn().execute(
+            "SELECT key FROM entries WHERE key >= ? ORDER BY key", (prefix,)
+        )
+        for (key,) in cursor:
+            if not key.startswith(prefix):
+                break
+            yield key
+
+    def iter_entries(self, prefix=""):
+        cursor = self._conn().execute(
+            "SELECT key, created, accessed, size FROM entries WHERE key >= ? "
+            "ORDER BY key",
+            (prefix,),
+        )
+        for key, created, accessed, size in cursor:
+            if not key.startswith(prefix):
+                break
+            yield key, Entry(None, created, accessed, size)
+
+    def stats(self):
+        entries, size = (
+            self._conn()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries")
+            .fetchone()
+        )
+        return {"entries": entries, "size": size}
+
+    def read_usage(self):
+        usage = {}
+        for namespace, counter, value in self._conn().execute(
+            "SELECT namespace, counter, value FROM usage"
+        ):
+            usage.setdefault(namespace, {})[counter] = value
+        return usage
+
+    def add_usage(self, usage):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT INTO usage (namespace, counter, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (namespace, counter) "
+                "DO UPDATE SET value = value + excluded.value",
+                [
+                    (namespace, counter, value)
+                    for namespace, counters in usage.items()
+                    for counter, value in counters.items()
+                ],
+            )
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+        self._local = threading.local()
+
+
+def _ensure_sqlite_columns(conn, table, columns):
+    existing = set(row[1] for row in conn.execute("PRAGMA table_info(%s)" % table))
+    added = []
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, decl))
+            added.append(name)
+    return added
+
+
+def backend():
+    """Returns the cache backend.
+
+    The backend is selected using `MY_GUILD_CACHE_BACKEND`, which may
+    be 'sqlite' (default) or 'dir'.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _init_backend(
+                os.getenv("MY_GUILD_CACHE_BACKEND") or DEFAULT_BACKEND
+            )
+        return _backend
+
+
+def _init_backend(name):
+    if name == "sqlite":
+        return SQLiteBackend(os.path.join(cache_dir, SQLITE_DB_NAME))
+    elif name == "dir":
+        return DirBackend(cache_dir)
+    else:
+        raise SystemExit(
+            "unsupported cache backend '%s' (expected 'sqlite' or 'dir')" % name
+        )
+
+
+def set_backend(val):
+    """Sets the cache backend.
+
+    `val` may be a Backend instance or a backend name.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+        _backend = val if isinstance(val, Backend) else _init_backend(val)
+    _clear_memo()
+
+
+def set_cache_dir(path):
+    """Sets the cache directory.
+
+    The backend is opened in the new directory on next use.
+    """
+    global _backend, cache_dir
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+            _backend = None
+        cache_dir = os.path.abspath(path)
+    _clear_memo()
+
+
+def set_site(site):
+    """Uses the default cache directory for a site.
+
+    `site` is a name for a site other than the default site or None
+    for the default site. Other sites are cached in 'sites/<site>'
+    under `DEFAULT_CACHE_DIR` so their entries don't mix with those
+    of the default site. Does nothing if MY_GUILD_CACHE_DIR is set.
+    """
+    if os.getenv("MY_GUILD_CACHE_DIR"):
+        return
+    path = os.path.expanduser(DEFAULT_CACHE_DIR)
+    if site:
+        path = os.path.join(path, "sites", site)
+    if os.path.abspath(path) != cache_dir:
+        set_cache_dir(path)
+
+
+###################################################################
+# Expiry and eviction
+###################################################################
+
+DAY = 86400
+
+# TTL in seconds by key namespace. A TTL of None means that entries in
+# the namespace don't expire.
+DEFAULT_TTLS = {
+    "link": 7 * DAY,
+    "topic-post": 30 * DAY,
+    "command": None,
+    "commands_category": 30 * DAY,
+    "http": 30 * DAY,
+}
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+EVICT_CHECK_INTERVAL = 100
+EVICT_TARGET_RATIO = 0.9
+
+_writes_since_evict_check = 0
+_evict_lock = threading.Lock()
+
+
+def key_namespace(key):
+    """Returns the namespace for a key.
+
+    The namespace is the part of the key before the first ':' or the
+    full key if it doesn't contain ':'.
+    """
+    return key.split(":", 1)[0]
+
+
+def namespace_ttl(namespace):
+    """Returns the TTL in seconds for entries in namespace.
+
+    Defaults in `DEFAULT_TTLS` may be overridden using environment
+    variables named `MY_GUILD_CACHE_TTL_<NAMESPACE>` where
+    `<NAMESPACE>` is upper case with '-' replaced by '_' (e.g.
+    `MY_GUILD_CACHE_TTL_TOPIC_POST`). Use 'none' to disable expiry.
+    """
+    env_name = "MY_GUILD_CACHE_TTL_%s" % namespace.upper().replace("-", "_")
+    env_val = os.getenv(env_name)
+    if not env_val:
+        return DEFAULT_TTLS.get(namespace)
+    if env_val.lower() == "none":
+        return None
+    try:
+        return float(env_val)
+    except ValueError:
+        raise SystemExit("invalid value for %s: %r" % (env_name, env_val))
+
+
+def max_size():
+    """Returns the maximum cache size in bytes.
+
+    Set using `MY_GUILD_CACHE_MAX_SIZE`, which may use a 'K', 'M' or
+    'G' suffix.
+    """
+    env_val = os.getenv("MY_GUILD_CACHE_MAX_SIZE")
+    if not env_val:
+        return DEFAULT_MAX_SIZE
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    scale = units.get(env_val[-1:].upper(), 1)
+    try:
+        return int(float(env_val[:-1] if scale > 1 else env_val) * scale)
+    except ValueError:
+        raise SystemExit("invalid value for MY_GUILD_CACHE_MAX_SIZE: %r" % env_val)
+
+
+def _expired(key, entry, now=None):
+    ttl = namespace_ttl(key_namespace(key))
+    return ttl is not None and (now or time.time()) - entry.created > ttl
+
+
+def _maybe_evict():
+    global _writes_since_evict_check
+    with _evict_lock:
+        _writes_since_evict_check += 1
+        if _writes_since_evict_check < EVICT_CHECK_INTERVAL:
+            return
+        _writes_since_evict_check = 0
+    evict()
+
+
+def evict():
+    """Deletes expired entries and least recently used entries.
+
+    Least recently used entries are deleted only when the cache
+    exceeds its maximum size, in which case entries are deleted until
+    the cache is `EVICT_TARGET_RATIO` of its maximum size.
+
+    Returns the number of deleted entries.
+    """
+    now = time.time()
+    live = []
+    deleted = 0
+    for key, entry in backend().iter_entries():
+        if _expired(key, entry, now):
+            delete(key)
+            deleted += 1
+        else:
+            live.append((key, entry))
+    size = sum(entry.size for _key, entry in live)
+    limit = max_size()
+    if size <= limit:
+        return deleted
+    log.debug(
+        "Cache size %i exceeds %i - evicting least recently used entries",
+        size,
+        limit,
+    )
+    target = limit * EVICT_TARGET_RATIO
+    for key, entry in sorted(live, key=lambda item: item[1].accessed):
+        if size <= target:
+            break
+        delete(key)
+        size -= entry.size
+        deleted += 1
+    return deleted
+
+
+###################################################################
+# Usage
+###################################################################
+
+USAGE_COUNTERS = (
+    "hits",
+    "memory-hits",
+    "misses",
+    "bytes-read",
+    "bytes-written",
+    "read-seconds",
+    "write-seconds",
+)
+
+_usage = {}
+_usage_lock = threading.Lock()
+
+
+def _record_usage(key, **counters):
+    namespace = key_namespace(key)
+    with _usage_lock:
+        ns_usage = _usage.setdefault(namespace, {})
+        for name, val in counters.items():
+            ns_usage[name] = ns_usage.get(name, 0) + val
+
+
+def _record_read(key, val, seconds=0.0):
+    if val is None:
+        _record_usage(key, misses=1, **{"read-seconds": seconds})
+        _trace_read(key, "miss", "backend", seconds)
+    else:
+        _record_usage(
+            key,
+            hits=1,
+            **{"bytes-read": _value_size(val), "read-seconds": seconds},
+        )
+        _trace_read(key, "hit", "backend", seconds)
+
+
+def _record_memory_hit(key):
+    _record_usage(key, hits=1, **{"memory-hits": 1})
+    _trace_read(key, "hit", "memory")
+
+
+def _trace_read(key, outcome, tier, seconds=0.0):
+    trace.event("cache", key=key, outcome=outcome, tier=tier, seconds=round(seconds, 6))
+
+
+def _value_size(val):
+    return len(val.encode("utf-8"))
+
+
+def flush_usage():
+    """Adds usage recorded by the process to persisted usage."""
+    with _usage_lock:
+        usage = dict(_usage)
+        _usage.clear()
+    if not usage:
+        return
+    try:
+        backend().add_usage(usage)
+    except Exception as e:
+        log.debug("Error saving cache usage: %s", e)
+
+
+atexit.register(flush_usage)
+
+
+def get_usage():
+    """Returns persisted usage combined with usage recorded by the
+    process.
+    """
+    flush_usage()
+    return backend().read_usage()
+
+
+def _format_usage(usage):
+    formatted = {}
+    for namespace, counters in sorted(usage.items()):
+        hits = int(counters.get("hits", 0))
+        misses = int(counters.get("misses", 0))
+        lookups = hits + misses
+        formatted[namespace] = {
+            "hits": hits,
+            "misses": misses,
+            "hit-ratio": round(hits / lookups, 3) if lookups else None,
+            "memory-hits": int(counters.get("memory-hits", 0)),
+            "bytes-read": int(counters.get("bytes-read", 0)),
+            "bytes-written": int(counters.get("bytes-written", 0)),
+            "read-seconds": round(counters.get("read-seconds", 0.0), 3),
+            "write-seconds": round(counters.get("write-seconds", 0.0), 3),
+        }
+    return formatted
+
+
+###################################################################
+# Locking
+###################################################################
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def locked(name):
+    """Holds an exclusive lock named `name` across threads and processes.
+
+    Use to guard read-modify-write operations on cache entries. The
+    lock is an advisory lock on a file in the cache 'locks' directory.
+    """
+    with _thread_lock(name):
+        lock_dir = os.path.join(cache_dir, "locks")
+        util.ensure_dir(lock_dir)
+        with open(os.path.join(lock_dir, "%s.lock" % name), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _thread_lock(name):
+    with _thread_locks_lock:
+        try:
+            return _thread_locks[name]
+        except KeyError:
+            lock = _thread_locks[name] = threading.Lock()
+            return lock
+
+
+###################################################################
+# Cache API
+###################################################################
+
+
+# Names of files created in the cache directory by backends and
+# `util.write_atomic`. `clear_all` deletes only these so that an
+# incorrect cache directory doesn't lose unrelated files.
+CACHE_FILE_P = re.compile(
+    r"(%s(-wal|-shm|-journal)?|usage\.json|[0-9a-f]{40}(\.key)?|\.tmp-.+)$"
+    % re.escape(SQLITE_DB_NAME)
+)
+LOCK_FILE_P = re.compile(r".+\.lock$")
 
 
 def clear_all():
-    assert os.path.isabs(cache_dir) and cache_dir.endswith(".cache/myguild"), cache_dir
+    assert os.path.isabs(cache_dir), cache_dir
     log.action("Clearing cache (%s)", cache_dir)
-    shutil.rmtree(cache_dir)
+    backend().close()
+    _clear_memo()
+    with _usage_lock:
+        _usage.clear()
+    _delete_cache_files(os.path.join(cache_dir, "locks"), LOCK_FILE_P)
+    _delete_cache_files(cache_dir, CACHE_FILE_P)
 
 
-def delete(key):
-    path = _key_path(key)
+def _delete_cache_files(dir, name_p):
+    """Deletes files in dir with names matching name_p.
+
+    dir is deleted if it's empty afterward.
+    """
     try:
-        os.remove(path)
+        names = os.listdir(dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(dir, name)
+        if name_p.match(name) and os.path.isfile(path):
+            util.ensure_deleted(path)
+    try:
+        os.rmdir(dir)
     except OSError as e:
-        if e.errno != errno.ENOENT:
+        if e.errno != errno.ENOTEMPTY:
             raise
+        log.debug("Files other than cache files in %s not deleted", dir)
+
+
+def delete(key):
+    _forget(key)
+    backend().delete(key)
+
+
+def _forget(key):
+    _memo.pop(key)
+    _parsed_memo.pop(key)
+
+
+def _clear_memo():
+    _memo.clear()
+    _parsed_memo.clear()
 
 
 def read(key):
-    path = _key_path(key)
+    val = _memo.get(key)
+    if val is not None:
+        _record_memory_hit(key)
+        return val
+    t0 = time.time()
+    val = _read_backend(key)
+    _record_read(key, val, time.time() - t0)
+    if val is not None:
+        _memo.put(key, val)
+    return val
+
+
+def read_json(key):
+    """Returns the decoded JSON value for key.
+
+    If the cached value is not valid JSON, the entry is deleted and
+    None is returned so that the caller refreshes the value.
+
+    Decoded values are held in memory and shared across calls. Callers
+    must not modify them.
+    """
+    return _read_parsed(key, json.loads)
+
+
+def read_int(key):
+    """Returns the integer value for key.
+
+    Invalid values are handled as they are by `read_json`.
+    """
+    return _read_parsed(key, int)
+
+
+def _read_parsed(key, parse):
+    parsed = _parsed_memo.get(key)
+    if parsed is not None and parsed[0] is parse:
+        _record_memory_hit(key)
+        return parsed[1]
+    val = read(key)
+    if val is None:
+        return None
     try:
-        return open(path).read()
-    except IOError as e:
-        if e.errno != errno.ENOENT:
-            raise
+        parsed_val = parse(val)
+    except ValueError:
+        log.warning("Cached value for %s is corrupt - refreshing", key)
+        delete(key)
         return None
+    else:
+        _parsed_memo.put(key, (parse, parsed_val))
+        return parsed_val
 
 
-def _key_path(key):
-    encoded_key = key.encode("utf-8")
-    digest = hashlib.sha1(encoded_key).hexdigest()
-    return os.path.join(cache_dir, digest)
+def _read_backend(key):
+    entry = backend().read(key)
+    if entry is None:
+        return None
+    if _expired(key, entry):
+        log.debug("Cache entry %s expired", key)
+        backend().delete(key)
+        return None
+    return entry.value
+
+
+def read_many(keys):
+    """Returns a dict of key to value for cached keys."""
+    keys = list(keys)
+    t0 = time.time()
+    vals = _read_many_backend(keys)
+    seconds = (time.time() - t0) / max(len(keys), 1)
+    for key in keys:
+        _record_read(key, vals.get(key), seconds)
+    return vals
+
+
+def _read_many_backend(keys):
+    entries = backend().read_many(keys)
+    now = time.time()
+    vals = {}
+    for key, entry in entries.items():
+        if _expired(key, entry, now):
+            log.debug("Cache entry %s expired", key)
+            backend().delete(key)
+        else:
+            vals[key] = entry.value
+    return vals
+
+
+def prefetch(keys):
+    """Reads entries for keys in a single batch.
+
+    Prefetched values are held in memory so that subsequent calls to
+    `read` don't access the backend. Hits and misses are recorded when
+    keys are read rather than when they're prefetched.
+
+    Returns the list of keys that are not cached.
+    """
+    keys = [key for key in keys if _memo.get(key) is None]
+    if not keys:
+        return []
+    t0 = time.time()
+    vals = _read_many_backend(keys)
+    seconds = (time.time() - t0) / len(keys)
+    for key in keys:
+        val = vals.get(key)
+        _record_usage(
+            key,
+            **{
+                "bytes-read": _value_size(val) if val is not None else 0,
+                "read-seconds": seconds,
+            }
+        )
+        if val is not None:
+            _memo.put(key, val)
+    return [key for key in keys if key not in vals]
 
 
 def write(key, value):
-    path = _key_path(key)
-    util.ensure_dir(os.path.dirname(path))
-    with open(path, "w") as f:
-        f.write(value)
+    write_many([(key, value)])
+
+
+def write_many(items):
+    items = list(items)
+    for key, _value in items:
+        _forget(key)
+    t0 = time.time()
+    backend().write_many(items)
+    seconds = (time.time() - t0) / max(len(items), 1)
+    for key, value in items:
+        _record_usage(
+            key, **{"bytes-written": _value_size(value), "write-seconds": seconds}
+        )
+        _memo.put(key, value)
+    _maybe_evict()
+
+
+def iter_keys(prefix=""):
+    return backend().iter_keys(prefix)
 
 
 def get_info():
+    b = backend()
+    stats = b.stats()
     return {
         "cache-dir": cache_dir,
-        "cache-entries": len(os.listdir(cache_dir)),
+        "cache-backend": b.name,
+        "cache-entries": stats["entries"],
+        "cache-size": stats["size"],
+        "cache-max-size": max_size(),
+        "cache-ttls": {
+            namespace: namespace_ttl(namespace) for namespace in sorted(DEFAULT_TTLS)
+        },
+        "cache-usage": _format_usage(get_usage()),
     }
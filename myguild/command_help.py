@@ -1,18 +1,29 @@
+import copy
 import datetime
+import hashlib
 import json
 import os
 import pprint
 import re
+import shlex
+import shutil
 import socket
 import subprocess
-
-import requests
+import threading
+import time
+import warnings
 
 from .api import init as init_api
 from .api import DiscourseClientError
+from .api import ensure_pool_maxsize
+from .api import base_url
+from .api import http_get
+from .api import site_url
 from .log_util import get_logger
 
 from . import cache
+from . import recording
+from . import trace
 from . import util
 
 log = get_logger()
@@ -55,55 +66,222 @@ class NoSuchCommand(Exception):
 ###################################################################
 
 
-def publish_commands(commands, preview=False, check=False):
+def publish_commands(commands, preview=False, check=False, jobs=1, guild_exe=None):
     api = init_api()
-    commands = sorted(_guild_commands(commands))
+    commands = sorted(_guild_commands(commands, jobs, guild_exe))
+    published = _published_command_posts(commands, jobs, api)
     for name, data in commands:
-        _sync_command(name, data, preview, check, api)
+        _sync_command(name, data, preview, check, api, published)
 
 
-def _guild_commands(cmd_names=None):
+def _guild_commands(cmd_names=None, jobs=1, guild_exe=None):
     cmds = []
     if cmd_names:
-        _acc_command_data(cmd_names, cmds)
+        _acc_command_data(cmd_names, guild_exe, cmds)
     else:
-        _acc_recurse_command_data("", cmds)
+        _acc_all_command_data("", _help_jobs(jobs, guild_exe), guild_exe, cmds)
     return cmds
 
 
-def _acc_command_data(cmd_names, cmds):
+def _help_jobs(jobs, guild_exe):
+    """Returns the number of concurrent help reads.
+
+    Concurrency applies only to reading help from the Guild
+    executable or from a recording. In-process help is read serially.
+    """
+    if guild_exe or recording.replaying() or _guild_main_cmd() is None:
+        return jobs
+    return 1
+
+
+def _acc_command_data(cmd_names, guild_exe, cmds):
+    _prefetch_cmd_help(cmd_names, guild_exe)
     for cmd in cmd_names:
         try:
-            data = _get_cmd_help_data(cmd)
+            data = _get_cmd_help_data(cmd, guild_exe)
         except NoSuchCommand:
             log.error("No such command '%s'", cmd)
         else:
             cmds.append((cmd, data))
 
 
-def _acc_recurse_command_data(base_cmd, acc):
-    (help_data, subcommands) = _cmd_help(base_cmd)
+def _acc_all_command_data(base_cmd, jobs, guild_exe, acc):
+    """Accumulates help for base_cmd and all of its subcommands.
+
+    The command tree is read one level at a time. Help for the
+    commands in a level is read concurrently using up to `jobs`
+    workers. Commands are accumulated in depth-first order.
+    """
+    tree = {}
+    level = [base_cmd]
+    while level:
+        _prefetch_cmd_help(level, guild_exe)
+        next_level = []
+        for cmd, future in util.pool_imap(
+            lambda cmd: _cmd_help(cmd, guild_exe), level, jobs
+        ):
+            tree[cmd] = future.result()
+            next_level.extend(
+                [subcmd for subcmd in tree[cmd][1] if subcmd not in tree]
+            )
+        level = next_level
+    _acc_command_tree(base_cmd, tree, acc)
+
+
+def _acc_command_tree(base_cmd, tree, acc):
+    help_data, subcommands = tree[base_cmd]
     if base_cmd:
         acc.append((base_cmd, help_data))
     for cmd in subcommands:
-        _acc_recurse_command_data(cmd, acc)
+        _acc_command_tree(cmd, tree, acc)
+
+
+def _prefetch_cmd_help(cmds, guild_exe):
+    cache.prefetch([cmd_cache_key(cmd, guild_exe) for cmd in cmds])
 
 
-def _cmd_help(cmd):
-    help_data = _get_cmd_help_data(cmd)
+def _cmd_help(cmd, guild_exe=None):
+    help_data = _get_cmd_help_data(cmd, guild_exe)
     log.debug("Help data for %s: %r", cmd, help_data)
     subcommands = _subcommands_for_help_data(help_data, cmd)
     return help_data, subcommands
 
 
-def _get_cmd_help_data(cmd):
+def _get_cmd_help_data(cmd, guild_exe=None):
+    with trace.correlation(_command_trace_id(cmd)):
+        return _get_cmd_help_data_impl(cmd, guild_exe)
+
+
+def _get_cmd_help_data_impl(cmd, guild_exe):
     cmd_desc = _cmd_desc(cmd)
-    cached = cache.read(_cmd_cache_key(cmd))
+    cache_key = cmd_cache_key(cmd, guild_exe)
+    cached = cache.read_json(cache_key)
     if cached:
         log.info("Reading cached command info for %s", cmd_desc)
-        return json.loads(cached)
+        return cached
     log.info("Fetching command info for %s", cmd_desc)
-    help_cmd = "guild %s --help" % cmd
+    t0 = time.time()
+    try:
+        out = _cmd_help_json(cmd, guild_exe)
+    except NoSuchCommand:
+        _trace_cmd_help(cmd, guild_exe, t0, found=False)
+        raise
+    _trace_cmd_help(cmd, guild_exe, t0)
+    cache.write(cache_key, out)
+    return json.loads(out)
+
+
+def _command_trace_id(cmd):
+    return "command:%s" % (cmd or "guild")
+
+
+def _trace_cmd_help(cmd, guild_exe, t0, found=True):
+    source = _cmd_help_source(guild_exe)
+    trace.event(
+        "guild-help",
+        cmd=cmd,
+        source=source,
+        command=(
+            _subprocess_help_cmd(cmd, guild_exe or "guild")
+            if source == "subprocess"
+            else None
+        ),
+        seconds=trace.elapsed(t0),
+        found=found,
+    )
+
+
+def _cmd_help_source(guild_exe):
+    if recording.replaying():
+        return "replay"
+    if guild_exe or _guild_main_cmd() is None:
+        return "subprocess"
+    return "in-process"
+
+
+def _cmd_help_json(cmd, guild_exe=None):
+    """Returns JSON formatted help for a Guild command.
+
+    Help is generated in-process from Guild's command group when Guild
+    can be imported and `guild_exe` is not specified. Otherwise help
+    is read from `<guild_exe> <cmd> --help`.
+    """
+    return recording.call(
+        "guild-help",
+        "%s:%s" % (guild_exe or "", cmd),
+        lambda: _read_cmd_help_json(cmd, guild_exe),
+        errors=(NoSuchCommand,),
+    )
+
+
+def _read_cmd_help_json(cmd, guild_exe):
+    main_cmd = None if guild_exe else _guild_main_cmd()
+    if main_cmd is None:
+        return _subprocess_cmd_help_json(cmd, guild_exe or "guild")
+    return _in_process_cmd_help_json(cmd, main_cmd)
+
+
+_guild_main_cmd_loaded = False
+_guild_main_cmd_val = None
+
+
+def _guild_main_cmd():
+    global _guild_main_cmd_loaded, _guild_main_cmd_val
+    if not _guild_main_cmd_loaded:
+        _guild_main_cmd_val = _try_import_guild_main_cmd()
+        _guild_main_cmd_loaded = True
+    return _guild_main_cmd_val
+
+
+def _try_import_guild_main_cmd():
+    try:
+        # pylint: disable=import-outside-toplevel
+        from guild import click_util
+        from guild.commands import main
+    except Exception as e:
+        log.debug(
+            "Cannot import Guild (%s) - using 'guild' executable for help", e
+        )
+        return None
+    else:
+        return main.main, click_util.JSONHelpFormatter
+
+
+def _in_process_cmd_help_json(cmd, main_cmd):
+    # Guild's warnings are written to stderr, which is not shown when
+    # help is read from the executable.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return _in_process_cmd_help_json_impl(cmd, main_cmd)
+
+
+def _in_process_cmd_help_json_impl(cmd, main_cmd):
+    group, formatter_cls = main_cmd
+    ctx = _help_context(group, "guild", None, formatter_cls)
+    for name in cmd.split():
+        subcmd = _get_subcommand(ctx, name)
+        if subcmd is None:
+            log.debug("Error reading help for '%s': no such command", cmd)
+            raise NoSuchCommand(cmd)
+        ctx = _help_context(subcmd, name, ctx, formatter_cls)
+    return ctx.command.get_help(ctx)
+
+
+def _help_context(cmd, name, parent, formatter_cls):
+    ctx = cmd.make_context(name, [], parent=parent, resilient_parsing=True)
+    ctx.make_formatter = formatter_cls
+    return ctx
+
+
+def _get_subcommand(ctx, name):
+    get_command = getattr(ctx.command, "get_command", None)
+    if get_command is None:
+        return None
+    return get_command(ctx, name)
+
+
+def _subprocess_cmd_help_json(cmd, guild_exe):
+    help_cmd = _subprocess_help_cmd(cmd, guild_exe)
     help_env = dict(os.environ)
     help_env["GUILD_HELP_JSON"] = "1"
     p = subprocess.Popen(
@@ -118,8 +296,11 @@ def _get_cmd_help_data(cmd):
     if p.returncode != 0:
         log.debug("Error reading help for '%s': %s", cmd, err)
         raise NoSuchCommand(cmd)
-    cache.write(_cmd_cache_key(cmd), out)
-    return json.loads(out)
+    return out
+
+
+def _subprocess_help_cmd(cmd, guild_exe):
+    return "%s %s --help" % (shlex.quote(guild_exe), cmd)
 
 
 def _cmd_desc(cmd):
@@ -129,8 +310,164 @@ def _cmd_desc(cmd):
         return "guild base command"
 
 
-def _cmd_cache_key(cmd):
-    return "command:%s" % cmd
+def cmd_cache_key(cmd, guild_exe=None):
+    """Returns the cache key for command help.
+
+    Keys are namespaced by a fingerprint of the Guild installation
+    used to generate help so that help is refreshed automatically
+    when Guild changes.
+    """
+    return "command:%s:%s" % (_help_namespace(guild_exe), cmd)
+
+
+def delete_cmd_cache(cmd):
+    """Deletes cached help for cmd in all namespaces."""
+    for key in list(cache.iter_keys("command:")):
+        if key.split(":", 2)[-1] == cmd:
+            cache.delete(key)
+
+
+###################################################################
+# Command help cache namespaces
+###################################################################
+
+HELP_NAMESPACES_CACHE_KEY = "command-namespaces"
+MAX_HELP_NAMESPACES = 3
+
+_help_namespaces = {}
+_help_namespaces_lock = threading.Lock()
+
+
+def _help_namespace(guild_exe=None):
+    with _help_namespaces_lock:
+        try:
+            return _help_namespaces[guild_exe]
+        except KeyError:
+            source, namespace = _guild_fingerprint(guild_exe)
+            _sync_help_namespaces(namespace, source)
+            _help_namespaces[guild_exe] = namespace
+            return namespace
+
+
+def _guild_fingerprint(guild_exe):
+    """Returns a tuple of Guild source and fingerprint.
+
+    Source is the location of the Guild installation used for help.
+    Fingerprint is a digest of the source along with its version and
+    modification time.
+    """
+    attrs = recording.call(
+        "guild-fingerprint",
+        guild_exe or "",
+        lambda: _guild_fingerprint_attrs(guild_exe),
+    )
+    encoded = json.dumps(attrs, sort_keys=True).encode("utf-8")
+    return attrs["source"], hashlib.sha1(encoded).hexdigest()[:12]
+
+
+def _guild_fingerprint_attrs(guild_exe):
+    main_cmd = None if guild_exe else _guild_main_cmd()
+    if main_cmd is None:
+        return _guild_exe_fingerprint_attrs(guild_exe or "guild")
+    return _guild_package_fingerprint_attrs()
+
+
+def _guild_package_fingerprint_attrs():
+    # pylint: disable=import-outside-toplevel
+    import guild
+
+    pkg_dir = os.path.dirname(os.path.abspath(guild.__file__))
+    return {
+        "source": pkg_dir,
+        "version": guild.__version__,
+        "mtime": _max_py_mtime([pkg_dir, os.path.join(pkg_dir, "commands")]),
+    }
+
+
+def _max_py_mtime(dirs):
+    mtimes = [0]
+    for dir in dirs:
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            continue
+        mtimes.extend(
+            [
+                util.mtime(os.path.join(dir, name))
+                for name in names
+                if name.endswith(".py")
+            ]
+        )
+    return max(mtimes)
+
+
+def _guild_exe_fingerprint_attrs(guild_exe):
+    exe_path = os.path.realpath(shutil.which(guild_exe) or guild_exe)
+    try:
+        mtime = util.mtime(exe_path)
+    except OSError:
+        mtime = None
+    return {
+        "source": exe_path,
+        "version": _guild_exe_version(guild_exe),
+        "mtime": mtime,
+    }
+
+
+def _guild_exe_version(guild_exe):
+    try:
+        out = subprocess.check_output(
+            [guild_exe, "--version"], stderr=subprocess.STDOUT, encoding="utf-8"
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.debug("Error reading version for '%s': %s", guild_exe, e)
+        return None
+    else:
+        return out.strip()
+
+
+def _sync_help_namespaces(namespace, source):
+    """Prepares the cache for help in namespace.
+
+    Namespaces for an earlier version of the same Guild source are
+    stale and their entries are deleted. Entries for least recently
+    used namespaces in excess of `MAX_HELP_NAMESPACES` are also
+    deleted.
+    """
+    with cache.locked(HELP_NAMESPACES_CACHE_KEY):
+        _sync_help_namespaces_impl(namespace, source)
+
+
+def _sync_help_namespaces_impl(namespace, source):
+    manifest = _read_help_namespaces()
+    for other, info in list(manifest.items()):
+        if other != namespace and info.get("source") == source:
+            log.info("Guild changed in %s - clearing cached command help", source)
+            _delete_help_namespace(other, manifest)
+    entry = manifest.setdefault(namespace, {"source": source})
+    entry["last-used"] = time.time()
+    by_last_used = sorted(
+        manifest.items(), key=lambda item: item[1]["last-used"], reverse=True
+    )
+    for other, _info in by_last_used[MAX_HELP_NAMESPACES:]:
+        log.debug("Deleting cached command help for %s", other)
+        _delete_help_namespace(other, manifest)
+    _write_help_namespaces(manifest)
+
+
+def _read_help_namespaces():
+    # Copy as the manifest is modified and cached values are shared.
+    return copy.deepcopy(cache.read_json(HELP_NAMESPACES_CACHE_KEY) or {})
+
+
+def _write_help_namespaces(manifest):
+    cache.write(HELP_NAMESPACES_CACHE_KEY, json.dumps(manifest))
+
+
+def _delete_help_namespace(namespace, manifest):
+    del manifest[namespace]
+    for key in list(cache.iter_keys("command:%s:" % namespace)):
+        cache.delete(key)
 
 
 def _subcommands_for_help_data(help_data, base_cmd):
@@ -156,20 +493,23 @@ def _join_cmd(base_cmd, subcmd):
     return "%s %s" % (base_cmd, subcmd)
 
 
-def _sync_command(cmd, data, preview, check, api):
-    util.retry(
-        "sync command '%s'" % cmd,
-        lambda: _sync_command_impl(cmd, data, preview, check, api),
-    )
+def _sync_command(cmd, data, preview, check, api, published=None):
+    with trace.correlation(_command_trace_id(cmd)):
+        util.retry(
+            "sync command '%s'" % cmd,
+            lambda: _sync_command_impl(cmd, data, preview, check, api, published),
+        )
 
 
-def _sync_command_impl(cmd, data, preview, check, api):
-    try:
-        post = _get_command_topic_post(cmd, api)
-    except DiscourseClientError:
-        _create_command_post(cmd, data, preview, check, api)
-    else:
-        _publish_command(cmd, data, post, api, preview=preview, check=check)
+def _sync_command_impl(cmd, data, preview, check, api, published):
+    post = (published or {}).get(cmd)
+    if post is None:
+        try:
+            post = _get_command_topic_post(cmd, api)
+        except DiscourseClientError:
+            _create_command_post(cmd, data, preview, check, api)
+            return
+    _publish_command(cmd, data, post, api, preview=preview, check=check)
 
 
 def _get_command_topic_post(cmd, api):
@@ -184,6 +524,69 @@ def _command_permalink(cmd):
     return "commands/%s" % cmd.replace(" ", "-")
 
 
+COMMANDS_BULK_MIN = 10
+COMMANDS_CATEGORY_MAX_PAGES = 50
+
+
+def _published_command_posts(commands, jobs, api):
+    """Returns a dict of command name to published help post.
+
+    When syncing `COMMANDS_BULK_MIN` or more commands, topics are
+    listed from the Commands category in pages and the first post of
+    each command topic is read using up to `jobs` concurrent requests.
+    This avoids a topic lookup by slug for each command.
+
+    Commands that don't have a topic in the category listing are not
+    included and are looked up individually.
+    """
+    if len(commands) < COMMANDS_BULK_MIN:
+        return {}
+    ensure_pool_maxsize(jobs)
+    slugs = {_command_help_slug(name): name for name, _data in commands}
+    topic_ids = {
+        slugs[topic["slug"]]: topic["id"]
+        for topic in _iter_commands_category_topics(api)
+        if topic.get("slug") in slugs
+    }
+    log.info("Fetching %i published help topic(s) from server", len(topic_ids))
+    posts = {}
+    for cmd, future in util.pool_imap(
+        lambda cmd: _command_first_post(cmd, topic_ids[cmd], api),
+        sorted(topic_ids),
+        jobs,
+    ):
+        try:
+            posts[cmd] = future.result()
+        except DiscourseClientError as e:
+            log.debug("Error reading help topic post for '%s': %s", cmd, e)
+    return posts
+
+
+def _iter_commands_category_topics(api):
+    category_id = _commands_category(api)
+    for page in range(COMMANDS_CATEGORY_MAX_PAGES):
+        data = api._get(
+            f"/c/{category_id}/l/latest.json",
+            override_request_kwargs={"allow_redirects": True},
+            page=page,
+        )
+        topic_list = data.get("topic_list") or {}
+        topics = topic_list.get("topics") or []
+        for topic in topics:
+            yield topic
+        if not topics or not topic_list.get("more_topics_url"):
+            break
+
+
+def _command_first_post(cmd, topic_id, api):
+    with trace.correlation(_command_trace_id(cmd)):
+        return _first_post(topic_id, api)
+
+
+def _first_post(topic_id, api):
+    return api._get(f"/posts/by_number/{topic_id}/1.json")
+
+
 def _create_command_post(cmd, data, preview, check, api):
     category = _commands_category(api)
     content = _format_command_help_post(cmd, data)
@@ -204,9 +607,9 @@ def _command_help_title(cmd):
 
 
 def _commands_category(api):
-    cached = cache.read("commands_category")
+    cached = cache.read_int("commands_category")
     if cached:
-        return int(cached)
+        return cached
     id = _guild_commands_topic_category(api)
     cache.write("commands_category", str(id))
     return id
@@ -335,9 +738,9 @@ def _publish_command_comment(help_data):
 ###################################################################
 
 
-def publish_index(preview=False, check=False, test=None):
+def publish_index(preview=False, check=False, test=None, jobs=1, guild_exe=None):
     api = init_api()
-    commands = sorted(_guild_commands(test))
+    commands = sorted(_guild_commands(test, jobs, guild_exe))
     assert commands
     version = commands[0][1]["version"]
     log.info("Generating command index")
@@ -433,15 +836,16 @@ def _publish_index_comment(version):
 ###################################################################
 
 
-def check_command_permalinks(commands):
+def check_command_permalinks(commands, jobs=1, guild_exe=None):
     api = init_api()
-    commands = sorted(_guild_commands(commands))
+    commands = sorted(_guild_commands(commands, jobs, guild_exe))
     for cmd, _data in commands:
-        _check_permalink(_command_permalink(cmd), cmd, api)
+        with trace.correlation(_command_trace_id(cmd)):
+            _check_permalink(_command_permalink(cmd), cmd, api)
 
 
 def _check_permalink(link, cmd, api):
-    resp = requests.get("https://my.guild.ai/%s" % link, allow_redirects=False)
+    resp = http_get(site_url(link), allow_redirects=False)
     if resp.status_code == 404:
         _no_permalink_error(link, cmd, api)
     elif resp.status_code != 301:
@@ -486,7 +890,7 @@ def _command_help_slug(cmd):
 def _check_permalink_redirect(link, resp, cmd, api):
     location = resp.headers.get("location")
     assert location, (link, resp)
-    m = re.match(r"https://my.guild.ai/t/[^/]+/([0-9]+)", location)
+    m = re.match(re.escape(base_url()) + r"/t/[^/]+/([0-9]+)", location)
     if not m:
         log.error("Unexpected redirect host for %s: %s", link, location)
     topic_id = int(m.group(1))
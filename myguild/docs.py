@@ -5,19 +5,22 @@ import json
 import os
 import pprint
 import re
-import shutil
 import socket
-import tempfile
 
-import requests
 import six
 import yaml
 
 from .api import init as init_api
 from .api import DiscourseClientError
+from .api import DiscourseError
+from .api import base_url
+from .api import conditional_get
+from .api import http_get
+from .api import site_url
 from .log_util import get_logger
 
 from . import cache
+from . import trace
 from . import util
 
 log = get_logger()
@@ -54,6 +57,7 @@ def publish_index(
 
 
 def _check_publish_links(check_links):
+    prefetch_link_topics(check_links)
     for link in check_links:
         try:
             topic = get_link_topic(link)
@@ -92,22 +96,15 @@ def _post_raw(post):
 
 
 def _diff_post(post_id, published, generated, diff_cmd):
-    tmp = tempfile.mkdtemp(prefix="myguild-diff-")
-    published_path = os.path.join(tmp, "post-%s.md" % post_id)
-    generated_path = os.path.join(tmp, "generated.md")
-    with open(published_path, "w") as f:
-        f.write(published)
-    with open(generated_path, "w") as f:
-        f.write(generated)
-    util.diff_files(published_path, generated_path, diff_cmd)
-    # Sanity check that we're deleting what we expect to delete.
-    assert sorted(os.listdir(tmp)) == ["generated.md", "post-%s.md" % post_id], tmp
-    shutil.rmtree(tmp)
+    util.diff_strings(
+        published, generated, "post-%s.md" % post_id, "generated.md", diff_cmd
+    )
 
 
 def _format_docs_index(index_path, force):
     lines = []
     index = _load_index(index_path)
+    prefetch_link_topics(_iter_links(index))
     _apply_index_header(lines)
     for item in index:
         _apply_index_item(item, force, lines)
@@ -116,7 +113,10 @@ def _format_docs_index(index_path, force):
 
 
 def iter_index_links(index_path):
-    index = _load_index(index_path)
+    return _iter_links(_load_index(index_path))
+
+
+def _iter_links(index):
     seen = set()
     for item in index:
         if "links" in item:
@@ -243,22 +243,44 @@ def _required(name, mapping):
 
 
 def get_link_topic(link):
-    cached = cache.read(link_topic_cache_key(link))
+    with trace.correlation(link_trace_id(link)):
+        return _get_link_topic(link)
+
+
+def _get_link_topic(link):
+    cached = cache.read_json(link_topic_cache_key(link))
     if cached:
         log.info("Using cached link info for %s", link)
-        return json.loads(cached)
+        return cached
     log.info("Refreshing topic info for %s", link)
     link_topic_json = get_link_topic_json(link)
     cache.write(link_topic_cache_key(link), link_topic_json)
     return json.loads(link_topic_json)
 
 
+def prefetch_link_topics(links):
+    """Reads cached topics for links in a single batch.
+
+    Links that aren't cached are resolved in bulk using the site
+    permalinks (see `_bulk_resolve_link_topics`).
+    """
+    links = list(links)
+    missing = set(cache.prefetch([link_topic_cache_key(link) for link in links]))
+    missing_links = [link for link in links if link_topic_cache_key(link) in missing]
+    if missing_links:
+        _bulk_resolve_link_topics(missing_links)
+
+
 def link_topic_cache_key(link):
     return "link:%s" % link
 
 
+def link_trace_id(link):
+    return "link:%s" % link
+
+
 def get_link_topic_json(link):
-    resp = requests.get("https://my.guild.ai/%s" % link, allow_redirects=False)
+    resp = http_get(site_url(link), allow_redirects=False)
     if resp.status_code == 404:
         log.error("Topic or permalink for '%s' does not exist", link)
         raise TopicLookupError(link)
@@ -276,12 +298,12 @@ def get_link_topic_json(link):
 
 def _link_topic_json_for_redirect(location, link):
     assert location, link
-    m = re.match(r"https://my.guild.ai/(.+)", location)
+    m = re.match(re.escape(base_url()) + r"/(.+)", location)
     if not m:
         log.error("Unexpected redirect host for %s: %s", link, location)
         raise TopicLookupError(link)
-    topic_info_url = "https://my.guild.ai/%s.json" % m.group(1)
-    resp = requests.get(topic_info_url, allow_redirects=False)
+    topic_info_url = site_url("%s.json" % m.group(1))
+    resp = conditional_get(topic_info_url, allow_redirects=False)
     if not resp.ok:
         log.error(
             "Error reading link topic from %s: %s (%s)",
@@ -351,3 +373,124 @@ def _publish_index_comment():
         host=socket.gethostname(),
         utc_date=datetime.datetime.utcnow().isoformat(),
     )
+
+
+###################################################################
+# Bulk link resolution
+###################################################################
+
+# Max permalinks returned by the admin permalinks listing.
+PERMALINKS_LIMIT = 100
+TOPIC_LISTING_MAX_PAGES = 20
+
+
+def _bulk_resolve_link_topics(links):
+    """Resolves and caches topics for links using the site permalinks.
+
+    Permalinks are read from the admin permalinks listing, which
+    requires API credentials with admin access. Topic titles missing
+    from permalinks are read from the latest topics listing.
+
+    Cached topics contain only 'id', 'title' and 'slug'. Links that
+    cannot be resolved here are resolved individually by
+    `get_link_topic`.
+    """
+    try:
+        api = init_api()
+    except SystemExit as e:
+        log.debug("Cannot resolve links in bulk: %s", e)
+        return
+    try:
+        permalinks = _site_permalinks(api, links)
+    except DiscourseError as e:
+        log.debug("Cannot read permalinks (%s) - resolving links individually", e)
+        return
+    topics = {}
+    for link in links:
+        permalink = permalinks.get(_normalize_link(link))
+        if permalink and permalink.get("topic_id"):
+            topics[link] = {
+                "id": permalink["topic_id"],
+                "title": permalink.get("topic_title"),
+                "slug": _topic_url_slug(permalink.get("topic_url")),
+            }
+    try:
+        _hydrate_topic_titles(
+            [topic for topic in topics.values() if not topic["title"]], api
+        )
+    except DiscourseError as e:
+        log.debug("Cannot read topic titles (%s) - resolving links individually", e)
+    resolved = [(link, topic) for link, topic in topics.items() if topic["title"]]
+    log.info(
+        "Resolved %i of %i link(s) using site permalinks", len(resolved), len(links)
+    )
+    cache.write_many(
+        [(link_topic_cache_key(link), json.dumps(topic)) for link, topic in resolved]
+    )
+
+
+def _site_permalinks(api, links):
+    """Returns a dict of normalized permalink URL to permalink for links.
+
+    The admin permalinks listing is not paged. It returns at most
+    `PERMALINKS_LIMIT` permalinks with URLs that contain the `filter`
+    param. Permalinks are read using one request for each distinct
+    first path segment of links. If a response is at the limit, links
+    it doesn't include are read using one request per link.
+    """
+    log.info("Reading site permalinks")
+    permalinks = {}
+    for prefix, prefix_links in sorted(_links_by_prefix(links).items()):
+        found, limited = _filtered_permalinks(prefix, api)
+        permalinks.update(found)
+        if not limited:
+            continue
+        for link in prefix_links:
+            if link not in permalinks:
+                permalinks.update(_filtered_permalinks(link, api)[0])
+    return permalinks
+
+
+def _links_by_prefix(links):
+    by_prefix = {}
+    for link in links:
+        link = _normalize_link(link)
+        by_prefix.setdefault(link.split("/", 1)[0], []).append(link)
+    return by_prefix
+
+
+def _filtered_permalinks(filter, api):
+    """Returns a tuple of permalinks matching filter and a limited flag.
+
+    The limited flag is True if the listing may be missing matches.
+    """
+    data = api._get("/admin/customize/permalinks.json", filter=filter)
+    listed = (data if isinstance(data, list) else data.get("permalinks")) or []
+    permalinks = {_normalize_link(permalink["url"]): permalink for permalink in listed}
+    return permalinks, len(listed) >= PERMALINKS_LIMIT
+
+
+def _topic_url_slug(topic_url):
+    m = re.match(r"/t/([^/]+)/\d+", topic_url or "")
+    return m.group(1) if m else None
+
+
+def _normalize_link(link):
+    return link.strip("/")
+
+
+def _hydrate_topic_titles(topics, api):
+    """Sets missing topic titles from the latest topics listing."""
+    by_id = {topic["id"]: topic for topic in topics}
+    for page in range(TOPIC_LISTING_MAX_PAGES):
+        if not by_id:
+            break
+        data = api._get("/latest.json", page=page)
+        listed = data.get("topic_list", {}).get("topics") or []
+        if not listed:
+            break
+        for listed_topic in listed:
+            topic = by_id.pop(listed_topic["id"], None)
+            if topic:
+                topic["title"] = listed_topic["title"]
+                topic["slug"] = listed_topic.get("slug")
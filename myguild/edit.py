@@ -1,15 +1,22 @@
 import datetime
 import logging
 import os
+import subprocess
+import threading
 import time
 
 from .api import DiscourseClientError
+from .api import ensure_pool_maxsize
 from .api import init as init_api
 from .api import public_get_data
+from .api import site_url
 from .log_util import get_logger
 
 from . import cache
 from . import docs
+from . import fswatch
+from . import manifest
+from . import trace
 from . import util
 
 log = get_logger()
@@ -42,6 +49,10 @@ def fetch(topic_id, save_dir=None, force=False):
             _save_topic(topic, save_dir)
 
 
+def topic_trace_id(topic_id):
+    return "topic:%s" % topic_id
+
+
 def _handle_fetch_topic_error(e, topic_id):
     if "not found" in str(e):
         raise SystemExit("Topic %i does not exit", topic_id)
@@ -70,9 +81,9 @@ def _topic_for_id(topic_id):
 
 
 def _post_id_for_topic(topic_id):
-    cached = cache.read(topic_post_cache_key(topic_id))
+    cached = cache.read_int(topic_post_cache_key(topic_id))
     if cached:
-        return int(cached)
+        return cached
     try:
         topic = _get_topic(topic_id)
     except DiscourseClientError:
@@ -88,11 +99,11 @@ def topic_post_cache_key(topic_id):
 
 
 def _get_topic(topic_id):
-    return public_get_data("https://my.guild.ai/t/%i.json" % topic_id)
+    return public_get_data(site_url("t/%i.json" % topic_id))
 
 
 def _get_post(post_id):
-    return public_get_data("https://my.guild.ai/posts/%i.json" % post_id)
+    return public_get_data(site_url("posts/%i.json" % post_id))
 
 
 def _post_raw(post):
@@ -120,7 +131,28 @@ def _check_save_conflict(topic, save_dir):
 
 
 def _files_differ(path1, path2):
-    return util.read_utf(path1) != util.read_utf(path2)
+    """Returns True if the contents of path1 and path2 differ.
+
+    Uses hashes from the save dir manifest, which are only recomputed
+    for files that changed since they were last hashed.
+    """
+    if path1 == path2:
+        return False
+    return _file_hash(path1) != _file_hash(path2)
+
+
+def _file_hash(path):
+    return manifest.for_dir(os.path.dirname(path)).file_hash(path)
+
+
+def _write_topic_file(path, raw):
+    util.write_utf(path, raw)
+    manifest.for_dir(os.path.dirname(path)).record(path, raw)
+
+
+def _delete_topic_file(path):
+    util.ensure_deleted(path)
+    manifest.for_dir(os.path.dirname(path)).forget(path)
 
 
 def _save_topic(topic, save_dir):
@@ -130,11 +162,11 @@ def _save_topic(topic, save_dir):
 
 
 def _save_topic_main(topic, save_dir, raw):
-    util.write_utf(_topic_path(topic, save_dir), raw)
+    _write_topic_file(_topic_path(topic, save_dir), raw)
 
 
 def _save_topic_base(topic, save_dir, raw):
-    util.write_utf(_topic_base_path(topic, save_dir), raw)
+    _write_topic_file(_topic_base_path(topic, save_dir), raw)
 
 
 def _topic_path(topic, save_dir):
@@ -163,7 +195,7 @@ def _topic_latest_path(topic, save_dir):
 ###################################################################
 
 
-def diff_base(topic_id, save_dir=None, diff_cmd=None):
+def diff_base(topic_id, save_dir=None, diff_cmd=None, color=None):
     save_dir = save_dir or default_save_dir()
     topic_path = _topic_path(topic_id, save_dir)
     if not os.path.exists(topic_path):
@@ -173,26 +205,46 @@ def diff_base(topic_id, save_dir=None, diff_cmd=None):
         raise SystemExit(
             "Base version for topic %i not found in %s", topic_id, save_dir
         )
-    util.diff_files(base_path, topic_path, diff_cmd)
+    util.diff_files(base_path, topic_path, diff_cmd, color)
 
 
-def diff_latest(topic_id, save_dir=None, diff_cmd=None):
+def diff_latest(topic_id, save_dir=None, diff_cmd=None, color=None):
     save_dir = save_dir or default_save_dir()
     topic_path = _topic_path(topic_id, save_dir)
     if not os.path.exists(topic_path):
         raise SystemExit("Topic %i not found in %s", topic_id, save_dir)
     log.info("Getting latest version of topic %i", topic_id)
     latest_path = _fetch_topic_latest(topic_id, save_dir)
-    util.diff_files(topic_path, latest_path, diff_cmd)
+    util.diff_files(topic_path, latest_path, diff_cmd, color)
 
 
 def _fetch_topic_latest(topic_id, save_dir):
-    topic = _topic_for_id(topic_id)
-    latest_path = _topic_latest_path(topic_id, save_dir)
-    util.write_utf(latest_path, topic.post_raw)
+    """Returns the path to the latest server version of a topic.
+
+    If the server post raw matches the base version of the topic, the
+    base path is returned. Otherwise the latest version is written to
+    the topic's '.latest' file and that path is returned.
+    """
+    return _save_topic_latest(_topic_for_id(topic_id), save_dir)
+
+
+def _save_topic_latest(topic, save_dir):
+    if _base_raw(topic, save_dir) == topic.post_raw:
+        log.debug("Topic %i unchanged on server", topic.topic_id)
+        _delete_topic_file(_topic_latest_path(topic, save_dir))
+        return _topic_base_path(topic, save_dir)
+    latest_path = _topic_latest_path(topic, save_dir)
+    _write_topic_file(latest_path, topic.post_raw)
     return latest_path
 
 
+def _base_raw(topic, save_dir):
+    try:
+        return util.read_utf(_topic_base_path(topic, save_dir))
+    except OSError:
+        return None
+
+
 ###################################################################
 # Publish
 ###################################################################
@@ -209,33 +261,40 @@ def publish(
     diff_cmd=None,
     edit_cmd=None,
 ):
+    """Publishes local changes to a topic.
+
+    The server post is read once. Unless `force` is specified, the
+    update is made conditional on the post raw that was read so that
+    changes made on the server in the meantime are not overwritten.
+    """
     api = init_api()
     save_dir = save_dir or default_save_dir()
     topic_path = _topic_path(topic_id, save_dir)
     if not os.path.exists(topic_path):
         raise SystemExit("Topic %i not found in %s", topic_id, save_dir)
-    if force or (
+    if force:
+        topic = None
+    else:
         _check_local_changed(topic_id, save_dir)
-        and _check_latest_changed(topic_id, save_dir)
-    ):
-        if not yes and not skip_diff:
-            base_path = _topic_base_path(topic_id, save_dir)
-            if not os.path.exists(base_path):
-                raise SystemExit(
-                    "Original post for topic %i not available for diff. Use "
-                    "--skip-diff to bypass this check."
-                )
-            util.diff_files(base_path, topic_path, diff_cmd)
-        if not yes and not skip_diff and not _confirm_publish(topic_id):
-            raise SystemExit(1)
-        comment = comment or (not no_comment and _get_comment(edit_cmd)) or ""
-        log.action("Publishing %i", topic_id)
-        topic = _topic_for_id(topic_id)
-        local_raw = util.read_utf(topic_path)
-        if not force:
-            _assert_latest_unchanged(topic_id, save_dir, topic.post_raw)
-        api.update_post(topic.post_id, local_raw, comment)
-        _save_topic_base(topic_id, save_dir, local_raw)
+        topic = _check_latest_changed(topic_id, save_dir)
+    if not yes and not skip_diff:
+        base_path = _topic_base_path(topic_id, save_dir)
+        if not os.path.exists(base_path):
+            raise SystemExit(
+                "Original post for topic %i not available for diff. Use "
+                "--skip-diff to bypass this check."
+            )
+        util.diff_files(base_path, topic_path, diff_cmd)
+    if not yes and not skip_diff and not _confirm_publish(topic_id):
+        raise SystemExit(1)
+    comment = comment or (not no_comment and _get_comment(edit_cmd)) or ""
+    log.action("Publishing %i", topic_id)
+    local_raw = util.read_utf(topic_path)
+    if topic:
+        _update_post_if_unchanged(api, topic, local_raw, comment)
+    else:
+        api.update_post(_post_id_for_topic(topic_id), local_raw, comment)
+    _save_topic_base(topic_id, save_dir, local_raw)
 
 
 def _check_local_changed(topic_id, save_dir):
@@ -261,7 +320,8 @@ def _check_latest_changed(topic_id, save_dir):
             "base version). Use --force to override this safeguard.",
             topic_id,
         )
-    latest_path = _fetch_topic_latest(topic_id, save_dir)
+    topic = _topic_for_id(topic_id)
+    latest_path = _save_topic_latest(topic, save_dir)
     if _files_differ(base_path, latest_path):
         raise SystemExit(
             "Topic %i has changed on the server since it was fetched. "
@@ -270,7 +330,7 @@ def _check_latest_changed(topic_id, save_dir):
             topic_id,
             topic_id,
         )
-    return True
+    return topic
 
 
 def _confirm_publish(topic_id):
@@ -285,14 +345,35 @@ def _get_comment(editor):
     return s
 
 
-def _assert_latest_unchanged(topic_id, save_dir, latest_raw):
-    latest_path = _fetch_topic_latest(topic_id, save_dir)
-    if util.read_utf(latest_path) != latest_raw:
-        raise SystemExit(
-            "Topic %i changed on the server since last check. Use --force to"
-            "override this safeguard.",
-            topic_id,
+def _update_post_if_unchanged(api, topic, raw, comment=""):
+    """Updates the post for topic if the server raw is unchanged.
+
+    Discourse rejects the update with a 409 (edit conflict) when
+    `raw_old` doesn't match the current post raw. A conflict is
+    reported as a SystemExit.
+    """
+    try:
+        return api.update_post(
+            topic.post_id, raw, comment, **{"post[raw_old]": _server_raw(topic)}
         )
+    except DiscourseClientError as e:
+        if _is_edit_conflict(e):
+            raise SystemExit(
+                "Topic %i changed on the server since last check. Use --force to "
+                "override this safeguard." % topic.topic_id
+            )
+        raise
+
+
+def _server_raw(topic):
+    # Inverse of `_post_raw`.
+    assert topic.post_raw.endswith("\n"), topic
+    return topic.post_raw[:-1]
+
+
+def _is_edit_conflict(e):
+    resp = getattr(e, "response", None)
+    return resp is not None and resp.status_code == 409
 
 
 ###################################################################
@@ -300,63 +381,304 @@ def _assert_latest_unchanged(topic_id, save_dir, latest_raw):
 ###################################################################
 
 
-def watch(topic_id, save_dir=None):
+DEFAULT_WATCH_DEBOUNCE = 0.5
+
+# Interval used to check for upload errors while waiting for saves.
+WATCH_ERROR_CHECK_INTERVAL = 1.0
+
+
+def watch(topic_ids=None, save_dir=None, poll=False, debounce=None, all=False):
+    """Publishes topics when they're saved.
+
+    Watches the topics in `topic_ids`, each of which is published once
+    at start if it has local changes. If `all` is True, watches all
+    topics in save_dir. Topics are not published at start in this
+    case - only topics saved while watching are published.
+
+    Uses inotify to detect saves when available. Otherwise, or when
+    `poll` is True, polls topic files for changes.
+
+    Saves are published in the background once a topic hasn't been
+    saved for `debounce` seconds. Saves made while waiting or
+    publishing are combined - the latest topic content is published.
+
+    If a topic changed on the server since it was fetched, the
+    conflict is reported and the topic is not published. Other topics
+    continue to be watched.
+    """
+    assert bool(topic_ids) != bool(all), (topic_ids, all)
     api = init_api()
     save_dir = save_dir or default_save_dir()
+    debounce = DEFAULT_WATCH_DEBOUNCE if debounce is None else debounce
+    if all:
+        watched = None
+        log.info("Watching topics in %s", os.path.relpath(save_dir))
+    else:
+        for topic_id in topic_ids:
+            _check_watch_topic(topic_id, save_dir)
+        watched = set(topic_ids)
+        log.info(
+            "Watching %s",
+            ", ".join(_watch_topic_desc(id, save_dir) for id in sorted(watched)),
+        )
+
+    def match(name):
+        topic_id = _topic_id_for_name(name)
+        return topic_id is not None and (watched is None or topic_id in watched)
+
+    def saved_since(since):
+        # Used when the watcher can't report which files were saved.
+        return sorted(
+            topic_id
+            for topic_id in watched or _iter_local_topic_ids(save_dir)
+            if _topic_saved_since(topic_id, save_dir, since)
+        )
+
+    def changed_topics(names):
+        if names is fswatch.ALL:
+            return saved_since(started)
+        return sorted(_topic_id_for_name(name) for name in names)
+
+    started = time.time()
+    uploader = _WatchUploader(api, save_dir, debounce)
+    with fswatch.watcher(save_dir, match, poll) as watcher:
+        changed = sorted(watched or [])
+        try:
+            while True:
+                uploader.check_error()
+                while changed:
+                    uploader.submit(changed.pop(0))
+                changed = changed_topics(watcher.wait(WATCH_ERROR_CHECK_INTERVAL))
+        finally:
+            try:
+                # Submit saves that were detected or are pending in the
+                # watcher so they're published or reported by `stop`.
+                for topic_id in changed + changed_topics(watcher.wait(0)):
+                    uploader.submit(topic_id)
+            finally:
+                uploader.stop()
+
+
+def _topic_saved_since(topic_id, save_dir, since):
+    try:
+        return util.mtime(_topic_path(topic_id, save_dir)) >= since
+    except OSError:
+        return False
+
+
+class _WatchUploader(object):
+    """Publishes saved topics on a background thread.
+
+    A topic is published when it hasn't been submitted for `debounce`
+    seconds. Errors are raised by `check_error` on the calling thread.
+
+    `stop` publishes pending saves without waiting for the debounce
+    period and waits for the thread to exit. Topics that are not
+    published are logged.
+    """
+
+    def __init__(self, api, save_dir, debounce):
+        self.api = api
+        self.save_dir = save_dir
+        self.debounce = debounce
+        self._pending = {}  # topic_id -> (first_save, last_save, save_count)
+        self._loops = {}
+        self._current = None
+        self._error = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, topic_id):
+        now = time.time()
+        with self._cond:
+            first, _last, count = self._pending.get(topic_id, (now, None, 0))
+            self._pending[topic_id] = (first, now, count + 1)
+            self._cond.notify()
+
+    def check_error(self):
+        with self._cond:
+            error = self._error
+        if error:
+            raise error
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            pending = bool(self._pending) and self._error is None
+            self._cond.notify()
+        if pending:
+            log.info("Publishing pending saves (press Ctrl-C to skip)")
+        try:
+            self._thread.join()
+        finally:
+            self._log_unpublished()
+
+    def _log_unpublished(self):
+        with self._cond:
+            topic_ids = set(self._pending)
+            if self._current is not None:
+                topic_ids.add(self._current)
+        for topic_id in sorted(topic_ids):
+            log.warning(
+                "Saved changes to topic %i were not published - use "
+                "'my-guild publish %i' to publish them",
+                topic_id,
+                topic_id,
+            )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                topic_id, saves = self._next_ready()
+                if topic_id is None:
+                    return
+                self._current = topic_id
+            try:
+                self._upload(topic_id, *saves)
+            except Exception as e:
+                error = _watch_upload_error(topic_id, e)
+                self._set_error(error)
+                _watch_notify_error(error)
+                return
+            except SystemExit as e:
+                self._set_error(e)
+                return
+            with self._cond:
+                self._current = None
+
+    def _set_error(self, e):
+        with self._cond:
+            self._error = e
+
+    def _next_ready(self):
+        while True:
+            now = time.time()
+            ready = [
+                (last, topic_id)
+                for topic_id, (_first, last, _count) in self._pending.items()
+                if self._stopped or now - last >= self.debounce
+            ]
+            if ready:
+                _last, topic_id = min(ready)
+                return topic_id, self._pending.pop(topic_id)
+            if self._stopped:
+                break
+            if self._pending:
+                next_last = min(last for _first, last, _count in self._pending.values())
+                self._cond.wait(next_last + self.debounce - now)
+            else:
+                self._cond.wait()
+        return None, None
+
+    def _upload(self, topic_id, first_save, last_save, save_count):
+        loop = self._loops.get(topic_id)
+        if loop is None:
+            loop = self._loops[topic_id] = util.SafeLoop(
+                limit_max=5,
+                limit_interval=5.0,
+                desc="topic %i published" % topic_id,
+            )
+        loop.check()
+        loop.incr()
+        with trace.correlation(topic_trace_id(topic_id)):
+            published = _watch_publish(self.api, topic_id, self.save_dir)
+        if published:
+            now = time.time()
+            log.info(
+                "Published topic %i %0.2fs after save%s",
+                topic_id,
+                now - last_save,
+                (
+                    " (%i saves, first %0.2fs ago)" % (save_count, now - first_save)
+                    if save_count > 1
+                    else ""
+                ),
+            )
+
+
+def _check_watch_topic(topic_id, save_dir):
     topic_path = _topic_path(topic_id, save_dir)
     if not os.path.exists(topic_path):
-        raise SystemExit("Topic %i not found in %s", topic_id, save_dir)
-    base_path = _topic_base_path(topic_id, save_dir)
-    if not os.path.exists(base_path):
+        raise SystemExit("Topic %i not found in %s" % (topic_id, save_dir))
+    if not os.path.exists(_topic_base_path(topic_id, save_dir)):
         raise SystemExit(
             "Missing base version for topic %i - cannot run watch" % topic_id
         )
+
+
+def _watch_topic_desc(topic_id, save_dir):
+    return "topic %i (%s)" % (
+        topic_id,
+        os.path.relpath(_topic_path(topic_id, save_dir)),
+    )
+
+
+def _topic_id_for_name(name):
+    if not name.endswith(".md"):
+        return None
+    try:
+        return int(name[:-3])
+    except ValueError:
+        return None
+
+
+def _watch_publish(api, topic_id, save_dir):
+    topic_path = _topic_path(topic_id, save_dir)
+    base_path = _topic_base_path(topic_id, save_dir)
+    if not os.path.exists(topic_path) or not os.path.exists(base_path):
+        log.debug("Skipping topic %i - not available for publish", topic_id)
+        return False
+    if not _local_topic_changed(topic_id, save_dir):
+        return False
     topic = _topic_for_id(topic_id)
-    log.info("Watching topic %i (%s)", topic_id, os.path.relpath(topic_path))
-    loop = util.SafeLoop(
-        limit_max=5,
-        limit_interval=5.0,
-        desc="topic %i (%s) modified" % (topic_id, topic_path),
+    latest_path = _save_topic_latest(topic, save_dir)
+    if _files_differ(base_path, latest_path):
+        _report_watch_conflict(topic_id)
+        return False
+    log.action(
+        "[%s] Publishing topic %i",
+        datetime.datetime.now().strftime("%D %T"),
+        topic_id,
     )
-    last_mtime = 0  # Try to publish once at start.
-    while loop:
-        cur_mtime = util.mtime(topic_path)
-        if cur_mtime > last_mtime:
-            loop.incr()
-            if _local_topic_changed(topic_id, save_dir):
-                latest_path = _fetch_topic_latest(topic_id, save_dir)
-                if _files_differ(base_path, latest_path):
-                    _latest_changed_on_watch_error(topic_id)
-                log.action(
-                    "[%s] Publishing topic %i",
-                    datetime.datetime.now().strftime("%D %T"),
-                    topic_id,
-                )
-                local_raw = util.read_utf(topic_path)
-                try:
-                    api.update_post(topic.post_id, local_raw)
-                except Exception as e:
-                    _update_post_on_watch_error(topic_id, e)
-                else:
-                    _save_topic_base(topic_id, save_dir, local_raw)
-            last_mtime = cur_mtime
-        time.sleep(0.1)
-
-
-def _latest_changed_on_watch_error(topic_id):
+    local_raw = util.read_utf(topic_path)
+    try:
+        _update_post_if_unchanged(api, topic, local_raw)
+    except SystemExit:
+        _report_watch_conflict(topic_id)
+        return False
+    except Exception as e:
+        _update_post_on_watch_error(topic_id, e)
+    else:
+        _save_topic_base(topic_id, save_dir, local_raw)
+        manifest.for_dir(save_dir).flush()
+        return True
+
+
+def _report_watch_conflict(topic_id):
     msg = (
-        "Topic %i has changed on the server since it was fetched. "
-        "Resolve this conflict using 'my-guild diff --latest %i and "
-        "publish the topic manually using --force."
+        "Topic %i has changed on the server since it was fetched - not "
+        "published. Resolve this conflict using 'my-guild diff --latest %i' "
+        "and publish the topic manually using --force."
     ) % (topic_id, topic_id)
-    util.notify_send("ERROR during my-guild watch: %s" % msg, urgency="critical")
-    raise SystemExit(msg)
+    log.error(msg)
+    _watch_notify_error(msg)
 
 
 def _update_post_on_watch_error(topic_id, e):
-    msg = "error publishing topic %i: %s" % (topic_id, e)
-    util.notify_send("ERROR during my-guild watch: %s" % msg, urgency="critical")
-    raise SystemExit(msg)
+    raise _watch_upload_error(topic_id, e)
+
+
+def _watch_upload_error(topic_id, e):
+    return SystemExit("error publishing topic %i: %s" % (topic_id, e))
+
+
+def _watch_notify_error(msg):
+    try:
+        util.notify_send("ERROR during my-guild watch: %s" % msg, urgency="critical")
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning("Cannot show desktop notification: %s", e)
 
 
 ###################################################################
@@ -380,7 +702,7 @@ def edit(
     topic_path = _topic_path(topic_id, save_dir)
     if not os.path.exists(topic_path):
         log.action("Fetching topic %s", topic_id)
-        topic = _topic_for_id(topic_id, api)
+        topic = _topic_for_id(topic_id)
         _save_topic(topic, save_dir)
     util.edit(topic_path, edit_cmd)
     base_path = _topic_base_path(topic_id, save_dir)
@@ -427,9 +749,9 @@ def _confirm_delete_local_files(topic_id):
 
 def _delete_local_topic(topic_id, save_dir):
     log.action("Removing local files for topic %i", topic_id)
-    util.ensure_deleted(_topic_latest_path(topic_id, save_dir))
-    util.ensure_deleted(_topic_base_path(topic_id, save_dir))
-    util.ensure_deleted(_topic_path(topic_id, save_dir))
+    _delete_topic_file(_topic_latest_path(topic_id, save_dir))
+    _delete_topic_file(_topic_base_path(topic_id, save_dir))
+    _delete_topic_file(_topic_path(topic_id, save_dir))
 
 
 ###################################################################
@@ -437,32 +759,38 @@ def _delete_local_topic(topic_id, save_dir):
 ###################################################################
 
 
-def fetch_docs(save_dir=None, index_path=None, force=None, stop_on_error=False):
-    index_path = docs.default_index_path()
+def fetch_docs(
+    save_dir=None, index_path=None, force=None, stop_on_error=False, jobs=1
+):
+    index_path = index_path or docs.default_index_path()
+    links = [
+        link
+        for link in docs.iter_index_links(index_path)
+        if not link.startswith("commands/")
+    ]
+    ensure_pool_maxsize(jobs)
+    docs.prefetch_link_topics(links)
+    fetched_topics = set()
+    fetched_topics_lock = threading.Lock()
+
+    def fetch_link(link):
+        with trace.correlation(docs.link_trace_id(link)):
+            return _fetch_doc_link(
+                link, save_dir, force, fetched_topics, fetched_topics_lock
+            )
+
     warnings = False
-    for link in docs.iter_index_links(index_path):
-        if link.startswith("commands/"):
-            continue
+    for _link, future in util.pool_imap(fetch_link, links, jobs):
         try:
-            topic_id = _topic_id_for_link(link)
-        except Exception as e:
-            if log.getEffectiveLevel() <= logging.DEBUG:
-                log.exception("topic for link '%s'", link)
-            log.error("Error reading topic for link '%s': %s", link, e)
+            link_warnings = future.result()
+        except SystemExit as e:
+            if stop_on_error:
+                raise
+            if e.args and not isinstance(e.args[0], int):
+                log.warning(*e.args)
             warnings = True
         else:
-            try:
-                util.retry(
-                    "fetch topic %i" % topic_id,
-                    # pylint: disable=cell-var-from-loop
-                    lambda: fetch(topic_id, save_dir=save_dir, force=force),
-                )
-            except SystemExit as e:
-                if stop_on_error:
-                    raise
-                if e.args and not isinstance(e.args[0], int):
-                    log.warning(*e.args)
-                warnings = True
+            warnings = warnings or link_warnings
     if warnings:
         raise SystemExit(
             "One or more warnings occurred while fetching docs. Refer to logs "
@@ -470,6 +798,33 @@ def fetch_docs(save_dir=None, index_path=None, force=None, stop_on_error=False):
         )
 
 
+def _fetch_doc_link(link, save_dir, force, fetched_topics, fetched_topics_lock):
+    """Fetches the topic for a docs link.
+
+    Returns True if a warning was logged. Raises SystemExit for fetch
+    errors, including save conflicts.
+
+    Links that resolve to a topic already fetched by another link are
+    skipped so that concurrent workers don't write the same files.
+    """
+    try:
+        topic_id = _topic_id_for_link(link)
+    except Exception as e:
+        if log.getEffectiveLevel() <= logging.DEBUG:
+            log.exception("topic for link '%s'", link)
+        log.error("Error reading topic for link '%s': %s", link, e)
+        return True
+    with fetched_topics_lock:
+        if topic_id in fetched_topics:
+            return False
+        fetched_topics.add(topic_id)
+    util.retry(
+        "fetch topic %i" % topic_id,
+        lambda: fetch(topic_id, save_dir=save_dir, force=force),
+    )
+    return False
+
+
 def _topic_id_for_link(link):
     return docs.get_link_topic(link)["id"]
 
@@ -489,8 +844,10 @@ def publish_all(
     save_dir=None,
     edit_cmd=None,
     diff_cmd=None,
+    jobs=1,
 ):
     init_api()  # Force early error if API creds not configured.
+    ensure_pool_maxsize(jobs)
     save_dir = save_dir or default_save_dir()
     if not yes and not skip_diff:
         topic_ids = diff_base_all(save_dir, diff_cmd)
@@ -503,14 +860,17 @@ def publish_all(
         raise SystemExit(1)
     comment = comment or (not no_comment and _get_comment(edit_cmd)) or ""
     assert comment or no_comment
-    warnings = False
-    for topic_id in topic_ids:
-        if not force and not _local_topic_changed(topic_id, save_dir):
-            continue
-        try:
+    if not force:
+        topic_ids = [
+            topic_id
+            for topic_id in topic_ids
+            if _local_topic_changed(topic_id, save_dir)
+        ]
+
+    def publish_topic(topic_id):
+        with trace.correlation(topic_trace_id(topic_id)):
             util.retry(
                 "publish topic %i" % topic_id,
-                # pylint: disable=cell-var-from-loop
                 lambda: publish(
                     topic_id,
                     save_dir=save_dir,
@@ -521,6 +881,11 @@ def publish_all(
                     yes=True,
                 ),
             )
+
+    warnings = False
+    for _topic_id, future in util.pool_imap(publish_topic, topic_ids, jobs):
+        try:
+            future.result()
         except SystemExit as e:
             if stop_on_error:
                 raise
@@ -529,7 +894,7 @@ def publish_all(
             warnings = True
     if warnings:
         raise SystemExit(
-            "One or more warnings occurred while fetching docs. Refer to logs "
+            "One or more warnings occurred while publishing topics. Refer to logs "
             "above for details."
         )
 
@@ -552,14 +917,21 @@ def _confirm_publish_all():
 ###################################################################
 
 
-def diff_base_all(save_dir=None, diff_cmd=None):
+def diff_base_all(save_dir=None, diff_cmd=None, color=None):
     save_dir = save_dir or default_save_dir()
-    diffed = []
-    for topic_id in sorted(_iter_local_topic_ids(save_dir)):
-        if not _local_topic_changed(topic_id, save_dir):
-            continue
-        diff_base(topic_id, save_dir=save_dir, diff_cmd=diff_cmd)
-        diffed.append(topic_id)
+    diffed = [
+        topic_id
+        for topic_id in sorted(_iter_local_topic_ids(save_dir))
+        if _local_topic_changed(topic_id, save_dir)
+    ]
+    util.diff_files_many(
+        [
+            (_topic_base_path(topic_id, save_dir), _topic_path(topic_id, save_dir))
+            for topic_id in diffed
+        ],
+        diff_cmd,
+        color,
+    )
     return diffed
 
 
@@ -568,22 +940,86 @@ def diff_base_all(save_dir=None, diff_cmd=None):
 ###################################################################
 
 
-def diff_latest_all(save_dir=None, diff_cmd=None):
+DEFAULT_DIFF_LATEST_JOBS = 4
+
+
+def diff_latest_all(save_dir=None, diff_cmd=None, color=None, jobs=None):
+    """Diffs local topics with their latest server versions.
+
+    Latest versions are read concurrently using up to `jobs` threads.
+    Diffs are shown in topic order as soon as each topic, and the
+    topics before it, are read.
+    """
     save_dir = save_dir or default_save_dir()
-    latest = []
-    for topic_id in sorted(_iter_local_topic_ids(save_dir)):
-        log.action("Getting latest version of topic %i", topic_id)
-        try:
-            latest_path = _fetch_topic_latest(topic_id, save_dir)
-        except DiscourseClientError as e:
-            log.warning("Could not get latest for topic %i: %s", topic_id, e)
-        else:
-            latest.append((topic_id, latest_path))
+    jobs = jobs or DEFAULT_DIFF_LATEST_JOBS
+    ensure_pool_maxsize(jobs)
+    topic_ids = sorted(_iter_local_topic_ids(save_dir))
+    log.action("Getting latest versions of %i topic(s)", len(topic_ids))
     diffed = []
-    for topic_id, latest_path in latest:
-        topic_path = _topic_path(topic_id, save_dir)
-        if not _files_differ(latest_path, topic_path):
-            continue
-        util.diff_files(topic_path, latest_path, diff_cmd)
-        diffed.append(topic_id)
+    errors = []
+
+    def fetch_latest(topic_id):
+        with trace.correlation(topic_trace_id(topic_id)):
+            return _fetch_topic_latest(topic_id, save_dir)
+
+    def path_pairs():
+        for topic_id, future in util.pool_imap(fetch_latest, topic_ids, jobs):
+            try:
+                latest_path = future.result()
+            except DiscourseClientError as e:
+                # Logged after diffs are shown to avoid writing to the
+                # terminal while the pager is running.
+                errors.append((topic_id, e))
+                continue
+            topic_path = _topic_path(topic_id, save_dir)
+            if not _files_differ(latest_path, topic_path):
+                continue
+            diffed.append(topic_id)
+            yield topic_path, latest_path
+
+    util.diff_files_many(path_pairs(), diff_cmd, color)
+    for topic_id, e in errors:
+        log.warning("Could not get latest for topic %i: %s", topic_id, e)
     return diffed
+
+
+###################################################################
+# Status
+###################################################################
+
+STATUS_MODIFIED = "modified"
+STATUS_CONFLICT = "conflict"
+STATUS_UNTRACKED = "untracked"
+
+
+def status(save_dir=None):
+    """Returns a list of (topic_id, status) for changed local topics.
+
+    Status is one of STATUS_MODIFIED, STATUS_CONFLICT, or
+    STATUS_UNTRACKED. A topic is in conflict when it's modified
+    locally and the latest server version, as last fetched, differs
+    from the base version.
+
+    Status is determined from local files only - use 'diff --latest'
+    to fetch the latest server versions.
+    """
+    save_dir = save_dir or default_save_dir()
+    changed = []
+    for topic_id in sorted(_iter_local_topic_ids(save_dir)):
+        topic_status = _topic_status(topic_id, save_dir)
+        if topic_status:
+            changed.append((topic_id, topic_status))
+    manifest.for_dir(save_dir).flush()
+    return changed
+
+
+def _topic_status(topic_id, save_dir):
+    base_path = _topic_base_path(topic_id, save_dir)
+    if not os.path.exists(base_path):
+        return STATUS_UNTRACKED
+    if not _files_differ(base_path, _topic_path(topic_id, save_dir)):
+        return None
+    latest_path = _topic_latest_path(topic_id, save_dir)
+    if os.path.exists(latest_path) and _files_differ(base_path, latest_path):
+        return STATUS_CONFLICT
+    return STATUS_MODIFIED
@@ -0,0 +1,463 @@
+import collections
+import datetime
+import hashlib
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+import click
+
+from .log_util import get_logger
+
+log = get_logger()
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+
+TOPICS_PER_PAGE = 30
+PERMALINKS_LIMIT = 100
+
+
+class FakeDiscourse(object):
+    """Local stand-in for the Discourse API used by my-guild.
+
+    Serves topics, posts, permalink redirects, topic listings, and
+    categories from memory, and accepts post updates and new posts.
+    Responses carry ETags and honor If-None-Match.
+
+    `latency` is a delay in seconds added to each request. When
+    `rate_limit_every` is N, every Nth request is answered with 429
+    and a Retry-After of `rate_limit_wait` seconds.
+
+    Request counts and bytes transferred are available from `stats`.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        rate_limit_every=0,
+        rate_limit_wait=1,
+    ):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.rate_limit_wait = rate_limit_wait
+        self.categories = {}
+        self.topics = {}
+        self.posts = {}
+        self.permalinks = {}
+        self._slugs = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%i" % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    ### Data
+
+    def add_category(self, name, slug=None):
+        with self._lock:
+            category_id = self._new_id()
+            self.categories[category_id] = {
+                "id": category_id,
+                "name": name,
+                "slug": slug or _slugify(name),
+                "read_restricted": False,
+            }
+            return category_id
+
+    def add_topic(self, title, raw, slug=None, category_id=None, permalink=None):
+        """Adds a topic with a first post containing raw.
+
+        Returns the topic ID.
+        """
+        with self._lock:
+            topic_id = self._new_topic(title, raw, slug, category_id)
+            if permalink:
+                self.permalinks[permalink.strip("/")] = topic_id
+            return topic_id
+
+    def add_permalink(self, url, topic_id):
+        with self._lock:
+            self.permalinks[url.strip("/")] = topic_id
+
+    def topic_for_slug(self, slug):
+        return self.topics[self._slugs[slug]]
+
+    def post_for_topic(self, topic_id):
+        return self.posts[self.topics[topic_id]["post_id"]]
+
+    def _new_id(self):
+        id = self._next_id
+        self._next_id += 1
+        return id
+
+    def _new_topic(self, title, raw, slug, category_id):
+        topic_id = self._new_id()
+        post_id = self._new_id()
+        slug = slug or _slugify(title)
+        self.topics[topic_id] = {
+            "id": topic_id,
+            "title": title,
+            "slug": slug,
+            "category_id": category_id,
+            "post_id": post_id,
+        }
+        self.posts[post_id] = {
+            "id": post_id,
+            "topic_id": topic_id,
+            "post_number": 1,
+            "raw": raw,
+            "version": 1,
+            "updated_at": _now(),
+        }
+        self._slugs[slug] = topic_id
+        return topic_id
+
+    ### Stats
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+    def _record(self, **counts):
+        with self._lock:
+            self._stats.update(counts)
+
+    def _should_rate_limit(self):
+        if not self.rate_limit_every:
+            return False
+        with self._lock:
+            self._stats["requests-seen"] += 1
+            return self._stats["requests-seen"] % self.rate_limit_every == 0
+
+    ### Views
+
+    def _topic_view(self, topic):
+        return {
+            "id": topic["id"],
+            "title": topic["title"],
+            "slug": topic["slug"],
+            "category_id": topic["category_id"],
+            "post_stream": {"posts": [{"id": topic["post_id"], "post_number": 1}]},
+            "details": {"created_by": {"username": "guildai"}},
+        }
+
+    def _list_view(self, topics, page):
+        topics = sorted(topics, key=lambda topic: topic["id"])
+        start = page * TOPICS_PER_PAGE
+        listed = topics[start : start + TOPICS_PER_PAGE]
+        topic_list = {
+            "topics": [
+                {"id": t["id"], "title": t["title"], "slug": t["slug"]} for t in listed
+            ]
+        }
+        if start + TOPICS_PER_PAGE < len(topics):
+            topic_list["more_topics_url"] = "/latest?page=%i" % (page + 1)
+        return {"topic_list": topic_list}
+
+    def _permalinks_view(self, filter=None):
+        # Like Discourse, the listing is filtered by URL substring and
+        # is not paged. Permalinks have a topic URL but no slug.
+        filter = (filter or "").lower()
+        urls = [url for url in sorted(self.permalinks) if filter in url.lower()]
+        return [self._permalink_view(url) for url in urls[:PERMALINKS_LIMIT]]
+
+    def _permalink_view(self, url):
+        topic = self.topics[self.permalinks[url]]
+        return {
+            "url": url,
+            "topic_id": topic["id"],
+            "topic_title": topic["title"],
+            "topic_url": "/t/%s/%i" % (topic["slug"], topic["id"]),
+        }
+
+    ### Updates
+
+    def _update_post(self, post_id, form):
+        with self._lock:
+            post = self.posts.get(post_id)
+            if post is None:
+                return 404, {"errors": ["not found"]}
+            raw_old = form.get("post[raw_old]")
+            if raw_old is not None and raw_old != post["raw"]:
+                return 409, {"errors": ["edit conflict"]}
+            raw = form.get("post[raw]")
+            if raw is None:
+                return 422, {"errors": ["missing raw"]}
+            post["raw"] = raw.rstrip()
+            post["version"] += 1
+            post["updated_at"] = _now()
+            return 200, {"post": dict(post)}
+
+    def _create_post(self, form):
+        title = form.get("title")
+        raw = form.get("raw")
+        if not title or not raw:
+            return 422, {"errors": ["title and raw are required"]}
+        category = form.get("category")
+        with self._lock:
+            topic_id = self._new_topic(
+                title, raw, None, int(category) if category else None
+            )
+            return 200, dict(self.posts[self.topics[topic_id]["post_id"]])
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    routes = [
+        ("GET", r"/t/(?P<id>\d+)(\.json)?", "get_topic"),
+        ("GET", r"/t/[^/]+/(?P<id>\d+)(\.json)?", "get_topic"),
+        ("GET", r"/t/(?P<slug>[^/]+?)(\.json)?", "get_topic_slug"),
+        ("GET", r"/posts/(?P<id>\d+)(\.json)?", "get_post"),
+        ("GET", r"/posts/by_number/(?P<id>\d+)/1(\.json)?", "get_first_post"),
+        ("GET", r"/admin/customize/permalinks(\.json)?", "get_permalinks"),
+        ("GET", r"/latest(\.json)?", "get_latest"),
+        ("GET", r"/c/(?P<id>\d+)/l/latest(\.json)?", "get_category_latest"),
+        ("GET", r"/c/(?P<id>\d+)/show(\.json)?", "get_category"),
+        ("GET", r"/site(\.json)?", "get_site"),
+        ("PUT", r"/posts/(?P<id>\d+)(\.json)?", "put_post"),
+        ("POST", r"/posts(\.json)?", "post_post"),
+        ("GET", r"/(?P<link>.+)", "get_permalink"),
+    ]
+
+    def log_message(self, format, *args):
+        log.debug("fake discourse: " + format, *args)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method):
+        fake = self.server.fake
+        body = self._read_body()
+        fake._record(**{"requests": 1, "bytes-received": len(body)})
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake._should_rate_limit():
+            fake._record(**{"rate-limited": 1})
+            self._send_json(
+                429,
+                {"extras": {"wait_seconds": fake.rate_limit_wait}},
+                {"Retry-After": str(fake.rate_limit_wait)},
+            )
+            return
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        form = dict(urllib.parse.parse_qsl(body.decode("utf-8")))
+        for route_method, pattern, name in self.routes:
+            if route_method != method:
+                continue
+            m = re.fullmatch(pattern, url.path)
+            if m:
+                getattr(self, name)(fake, m, query, form)
+                return
+        self._send_json(404, {"errors": ["not found"]})
+
+    def _read_body(self):
+        length = int(self.headers.get("content-length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    ### Routes
+
+    def get_topic(self, fake, m, query, form):
+        topic = fake.topics.get(int(m.group("id")))
+        if topic is None:
+            self._send_json(404, {"errors": ["not found"]})
+        else:
+            self._send_json(200, fake._topic_view(topic))
+
+    def get_topic_slug(self, fake, m, query, form):
+        topic_id = fake._slugs.get(m.group("slug"))
+        if topic_id is None:
+            self._send_json(404, {"errors": ["not found"]})
+        else:
+            topic = fake.topics[topic_id]
+            self._redirect("/t/%s/%i.json" % (topic["slug"], topic["id"]))
+
+    def get_post(self, fake, m, query, form):
+        post = fake.posts.get(int(m.group("id")))
+        if post is None:
+            self._send_json(404, {"errors": ["not found"]})
+        else:
+            self._send_json(200, post)
+
+    def get_first_post(self, fake, m, query, form):
+        topic = fake.topics.get(int(m.group("id")))
+        if topic is None:
+            self._send_json(404, {"errors": ["not found"]})
+        else:
+            self._send_json(200, fake.posts[topic["post_id"]])
+
+    def get_permalinks(self, fake, m, query, form):
+        self._send_json(200, fake._permalinks_view(query.get("filter")))
+
+    def get_latest(self, fake, m, query, form):
+        page = int(query.get("page") or 0)
+        self._send_json(200, fake._list_view(fake.topics.values(), page))
+
+    def get_category_latest(self, fake, m, query, form):
+        category_id = int(m.group("id"))
+        page = int(query.get("page") or 0)
+        topics = [t for t in fake.topics.values() if t["category_id"] == category_id]
+        self._send_json(200, fake._list_view(topics, page))
+
+    def get_category(self, fake, m, query, form):
+        category = fake.categories.get(int(m.group("id")))
+        if category is None:
+            self._send_json(404, {"errors": ["not found"]})
+        else:
+            self._send_json(200, {"category": category})
+
+    def get_site(self, fake, m, query, form):
+        self._send_json(200, {"categories": list(fake.categories.values())})
+
+    def get_permalink(self, fake, m, query, form):
+        topic_id = fake.permalinks.get(m.group("link").strip("/"))
+        if topic_id is None:
+            self._send_json(404, {"errors": ["not found"]})
+        else:
+            topic = fake.topics[topic_id]
+            self._redirect("/t/%s/%i" % (topic["slug"], topic["id"]))
+
+    def put_post(self, fake, m, query, form):
+        self._send_json(*fake._update_post(int(m.group("id")), form))
+
+    def post_post(self, fake, m, query, form):
+        self._send_json(*fake._create_post(form))
+
+    ### Responses
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if status == 200 and self.headers.get("if-none-match") == etag:
+            self._send(304, b"", {"ETag": etag})
+        else:
+            headers = dict(headers or {})
+            headers["Content-Type"] = JSON_CONTENT_TYPE
+            if status == 200:
+                headers["ETag"] = etag
+            self._send(status, body, headers)
+
+    def _redirect(self, path):
+        location = self.server.fake.url + path
+        self._send(301, b"", {"Location": location})
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        for name, val in headers.items():
+            self.send_header(name, val)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+        self.server.fake._record(**{"bytes-sent": len(body)})
+
+
+def _slugify(s):
+    return re.sub(r"[^a-z0-9]+", "-", s.lower()).strip("-")
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat() + "Z"
+
+
+def populate(fake, topics, topic_lines=40):
+    """Adds synthetic content to a fake site.
+
+    Adds the docs and commands index topics and a Commands category,
+    and `topics` docs topics, each with a 'bench/doc-<N>' permalink.
+
+    Returns a list of docs topic permalinks.
+    """
+    fake.add_topic(
+        "Guild AI Documentation",
+        "Docs index",
+        slug="guild-ai-documentation",
+        permalink="docs",
+    )
+    commands_category = fake.add_category("Commands")
+    fake.add_topic(
+        "Guild AI Commands",
+        "Commands index",
+        slug="guild-ai-commands",
+        category_id=commands_category,
+        permalink="commands",
+    )
+    links = []
+    for i in range(topics):
+        link = "bench/doc-%i" % i
+        raw = "\n".join(
+            "Line %i of synthetic topic %i." % (line, i) for line in range(topic_lines)
+        )
+        fake.add_topic("Doc %i" % i, raw, slug="doc-%i" % i, permalink=link)
+        links.append(link)
+    return links
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Host to listen on.")
+@click.option("-p", "--port", type=int, default=8080, help="Port to listen on.")
+@click.option(
+    "-t", "--topics", type=int, default=100, help="Number of synthetic topics."
+)
+@click.option("--latency", type=float, default=0.0, help="Seconds added per request.")
+@click.option(
+    "--rate-limit-every",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Respond to every Nth request with 429.",
+)
+def main(host, port, topics, latency, rate_limit_every):
+    """Run a local fake Discourse site for my-guild."""
+    from . import log_util
+
+    log_util.init(False)
+    fake = FakeDiscourse(host, port, latency, rate_limit_every)
+    populate(fake, topics)
+    log.info("Serving fake Discourse at %s (Ctrl-C to stop)", fake.url)
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from .log_util import get_logger
+
+log = get_logger()
+
+DEFAULT_POLL_INTERVAL = 0.1
+
+# Events are collected for this long after the first event so that
+# multi-step saves are reported together.
+SETTLE_INTERVAL = 0.05
+
+# Returned by `wait` when changes may have been missed - callers
+# should treat all files as changed.
+ALL = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+
+class InotifyWatcher(object):
+    def __init__(self, dir, match=None):
+        self.dir = dir
+        self.match = match
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self._fd < 0:
+            _raise_errno("inotify_init1")
+        wd = self._libc.inotify_add_watch(
+            self._fd,
+            os.fsencode(dir),
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF,
+        )
+        if wd < 0:
+            os.close(self._fd)
+            _raise_errno("inotify_add_watch")
+
+    def wait(self, timeout=None):
+        """Waits for saved files.
+
+        Returns a set of saved file names, which is empty if `timeout`
+        (seconds) elapses, or ALL if events were lost.
+        """
+        if not self._select(timeout):
+            return set()
+        names = set()
+        while True:
+            for mask, name in self._read_events():
+                if mask & IN_Q_OVERFLOW:
+                    return ALL
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    raise SystemExit("%s was removed or moved" % self.dir)
+                if name and (not self.match or self.match(name)):
+                    names.add(name)
+            if not self._select(SETTLE_INTERVAL):
+                return names
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _select(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        return bool(readable)
+
+    def _read_events(self):
+        try:
+            buf = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(buf):
+            _wd, mask, _cookie, name_len = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos : pos + name_len].rstrip(b"\0")
+            pos += name_len
+            yield mask, os.fsdecode(name)
+
+
+class PollingWatcher(object):
+    def __init__(self, dir, match=None, interval=DEFAULT_POLL_INTERVAL):
+        self.dir = dir
+        self.match = match
+        self.interval = interval
+        self._stats = self._scan()
+
+    def wait(self, timeout=None):
+        """Waits for saved files.
+
+        Returns a set of saved file names, which is empty if `timeout`
+        (seconds) elapses.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            stats = self._scan()
+            names = {
+                name for name, stat in stats.items() if self._stats.get(name) != stat
+            }
+            self._stats = stats
+            if names:
+                return names
+            if deadline is not None and time.time() >= deadline:
+                return set()
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _scan(self):
+        try:
+            names = os.listdir(self.dir)
+        except FileNotFoundError:
+            raise SystemExit("%s was removed or moved" % self.dir)
+        stats = {}
+        for name in names:
+            if self.match and not self.match(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.dir, name))
+            except OSError:
+                continue
+            stats[name] = (st.st_mtime_ns, st.st_size, st.st_ino)
+        return stats
+
+
+def watcher(dir, match=None, poll=False):
+    """Returns a watcher for files saved in dir.
+
+    `match` is an optional function that's called with a file name and
+    returns True if the file should be reported.
+
+    Uses inotify unless `poll` is True or inotify is not available, in
+    which case file stats are polled.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(dir, match)
+        except OSError as e:
+            log.debug("inotify not available (%s), polling for changes", e)
+    return PollingWatcher(dir, match)
+
+
+def _libc():
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.ENOSYS, "inotify requires Linux")
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+    try:
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+    except AttributeError:
+        raise OSError(errno.ENOSYS, "inotify not supported by libc")
+    return libc
+
+
+def _raise_errno(desc):
+    err = ctypes.get_errno()
+    raise OSError(err, "%s: %s" % (desc, os.strerror(err)))
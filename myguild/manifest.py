@@ -0,0 +1,149 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .log_util import get_logger
+
+from . import util
+
+log = get_logger()
+
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+
+# Entries for files modified this close to when they were recorded
+# are not trusted. A later change within the same mtime tick may not
+# change size or mtime. 2 seconds covers file systems with coarse
+# mtime resolution.
+RACY_INTERVAL_NS = 2 * 10**9
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+class Manifest(object):
+    """Size, mtime, and content hash of files in a save dir.
+
+    File names are relative to the save dir. An entry is valid as long
+    as the file size and mtime are unchanged. Otherwise the file is
+    hashed again and the entry updated.
+    """
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, MANIFEST_NAME)
+        self._files = _read_manifest_files(self.path)
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def file_hash(self, path):
+        """Returns the content hash for path.
+
+        Raises OSError if path does not exist.
+        """
+        st = os.stat(path)
+        name = self._name(path)
+        with self._lock:
+            entry = self._files.get(name)
+        if entry and _entry_matches(entry, st):
+            return entry["sha1"]
+        sha1 = _text_sha1(util.read_utf(path))
+        self._set_entry(name, st, sha1)
+        return sha1
+
+    def record(self, path, s):
+        """Records the hash for s, which was just written to path."""
+        st = os.stat(path)
+        self._set_entry(self._name(path), st, _text_sha1(s))
+
+    def forget(self, path):
+        name = self._name(path)
+        with self._lock:
+            if self._files.pop(name, None) is not None:
+                self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {"version": MANIFEST_VERSION, "files": dict(self._files)}
+            self._dirty = False
+        try:
+            util.write_atomic(self.path, json.dumps(data, sort_keys=True))
+        except OSError as e:
+            log.debug("error writing %s: %s", self.path, e)
+
+    def _name(self, path):
+        return os.path.relpath(os.path.abspath(path), self.save_dir)
+
+    def _set_entry(self, name, st, sha1):
+        entry = {
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "checked": time.time_ns(),
+            "sha1": sha1,
+        }
+        with self._lock:
+            self._files[name] = entry
+            self._dirty = True
+
+
+def _read_manifest_files(path):
+    try:
+        data = json.loads(util.read_utf(path))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.debug("ignoring invalid manifest %s: %s", path, e)
+        return {}
+    if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+        return {}
+    files = data.get("files")
+    return files if isinstance(files, dict) else {}
+
+
+def _entry_matches(entry, st):
+    try:
+        return (
+            entry["size"] == st.st_size
+            and entry["mtime"] == st.st_mtime_ns
+            and entry["mtime"] < entry["checked"] - RACY_INTERVAL_NS
+        )
+    except (KeyError, TypeError):
+        return False
+
+
+def _text_sha1(s):
+    # Files are compared as read by `util.read_utf`, which applies
+    # universal newlines.
+    s = s.replace("\r\n", "\n").replace("\r", "\n")
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+def for_dir(save_dir):
+    """Returns the manifest for save_dir.
+
+    Manifests are shared for the life of the process and written when
+    the process exits or when `flush` is called.
+    """
+    save_dir = os.path.abspath(save_dir)
+    with _manifests_lock:
+        try:
+            return _manifests[save_dir]
+        except KeyError:
+            m = _manifests[save_dir] = Manifest(save_dir)
+            return m
+
+
+def flush():
+    with _manifests_lock:
+        manifests = list(_manifests.values())
+    for m in manifests:
+        if os.path.isdir(m.save_dir):
+            m.flush()
+
+
+atexit.register(flush)
@@ -0,0 +1,371 @@
+import asyncio
+import atexit
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import requests
+import requests.structures
+
+from .log_util import get_logger
+
+from . import cache
+from . import util
+
+log = get_logger()
+
+EXCHANGES_NAME = "exchanges.jsonl"
+
+# Request headers used to revalidate responses. They are not sent when
+# recording so that full responses are recorded. On replay they're
+# answered using recorded validators.
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since")
+
+# Response headers used on replay. Other headers, which may include
+# cookies and session info, are not recorded.
+RECORDED_RESPONSE_HEADERS = ("content-type", "location", "etag", "last-modified")
+
+_recorder = None
+
+
+class Recorder(object):
+    """Records HTTP exchanges and Guild help output to a directory."""
+
+    mode = "record"
+
+    def __init__(self, dir):
+        self.dir = dir
+        util.ensure_dir(dir)
+        self._path = os.path.join(dir, EXCHANGES_NAME)
+        self._f = open(self._path, "w", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def http_request(self, send, method, url, kw):
+        kw = _record_kw(kw)
+        t0 = time.time()
+        resp = send(method, url, **kw)
+        self._write_http(method, url, kw, resp, t0)
+        return resp
+
+    async def http_request_async(self, send, method, url, kw):
+        kw = _record_kw(kw)
+        t0 = time.time()
+        resp = await send(method, url, **kw)
+        self._write_http(method, url, kw, resp, t0)
+        return resp
+
+    def _write_http(self, method, url, kw, resp, t0):
+        self._write(
+            {
+                "type": "http",
+                "key": http_key(method, url, kw),
+                "method": method,
+                "url": url,
+                "elapsed": time.time() - t0,
+                "response": _encode_response(resp),
+            }
+        )
+
+    def call(self, kind, key, f, errors):
+        t0 = time.time()
+        try:
+            result = f()
+        except errors as e:
+            error = {"type": type(e).__name__, "args": list(e.args)}
+            self._write_call(kind, key, None, error, time.time() - t0)
+            raise
+        else:
+            self._write_call(kind, key, result, None, time.time() - t0)
+            return result
+
+    def _write_call(self, kind, key, result, error, elapsed):
+        self._write(
+            {
+                "type": kind,
+                "key": key,
+                "result": result,
+                "error": error,
+                "elapsed": elapsed,
+            }
+        )
+
+    def _write(self, exchange):
+        line = json.dumps(exchange, sort_keys=True)
+        with self._lock:
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+class Replayer(object):
+    """Serves exchanges recorded by `Recorder`.
+
+    Exchanges with the same key are served in recorded order. Once all
+    have been served, the last is served again.
+
+    `latency` is either a delay in seconds added to each replayed
+    exchange or 'recorded' to delay by the recorded duration.
+    """
+
+    mode = "replay"
+
+    def __init__(self, dir, latency=None):
+        self.dir = dir
+        self.latency = latency
+        self._exchanges = _read_exchanges(os.path.join(dir, EXCHANGES_NAME))
+        self._served = {}
+        self._lock = threading.Lock()
+
+    def http_request(self, send, method, url, kw):
+        exchange = self._next_http(method, url, kw)
+        time.sleep(self._latency(exchange))
+        return _replayed_response(exchange, kw)
+
+    async def http_request_async(self, send, method, url, kw):
+        exchange = self._next_http(method, url, kw)
+        await asyncio.sleep(self._latency(exchange))
+        return _replayed_response(exchange, kw)
+
+    def _next_http(self, method, url, kw):
+        key = http_key(method, url, kw)
+        return self._next(("http", key), "%s %s" % (method, url))
+
+    def call(self, kind, key, f, errors):
+        exchange = self._next((kind, key), "%s %s" % (kind, key))
+        time.sleep(self._latency(exchange))
+        error = exchange.get("error")
+        if error:
+            raise _error_for_type(error["type"], errors)(*error["args"])
+        return exchange["result"]
+
+    def _next(self, key, desc):
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if not exchanges:
+                raise SystemExit("no recorded response for %s in %s" % (desc, self.dir))
+            i = self._served.get(key, 0)
+            self._served[key] = i + 1
+            return exchanges[min(i, len(exchanges) - 1)]
+
+    def _latency(self, exchange):
+        if self.latency == "recorded":
+            return exchange.get("elapsed") or 0
+        return self.latency or 0
+
+    def close(self):
+        pass
+
+
+def http_key(method, url, kw):
+    """Returns the key used to match a request on replay.
+
+    The key is a digest of the method, URL including query params, and
+    body. Request headers, which include credentials, are not used.
+    """
+    req = requests.Request(
+        method,
+        url,
+        params=kw.get("params"),
+        data=kw.get("data"),
+        json=kw.get("json"),
+    ).prepare()
+    body = req.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    h = hashlib.sha1()
+    h.update(("%s %s\n" % (method.upper(), req.url)).encode("utf-8"))
+    h.update(body)
+    return h.hexdigest()
+
+
+def _error_for_type(name, errors):
+    for cls in errors:
+        if cls.__name__ == name:
+            return cls
+    raise SystemExit("cannot replay error %s: unexpected error type" % name)
+
+
+def _record_kw(kw):
+    kw = dict(kw)
+    kw["headers"] = _strip_conditional_headers(kw.get("headers"))
+    return kw
+
+
+def _strip_conditional_headers(headers):
+    if not headers:
+        return headers
+    return {
+        name: val
+        for name, val in headers.items()
+        if name.lower() not in CONDITIONAL_HEADERS
+    }
+
+
+def _encode_response(resp):
+    encoded = {
+        "status": resp.status_code,
+        "reason": resp.reason,
+        "headers": {
+            name: val
+            for name, val in resp.headers.items()
+            if name.lower() in RECORDED_RESPONSE_HEADERS
+        },
+    }
+    try:
+        encoded["body"] = resp.content.decode("utf-8")
+    except UnicodeDecodeError:
+        encoded["body_b64"] = base64.b64encode(resp.content).decode("ascii")
+    return encoded
+
+
+def _replayed_response(exchange, kw):
+    resp = _decode_response(exchange["response"], exchange["url"])
+    if _not_modified(resp, kw.get("headers")):
+        return _not_modified_response(resp)
+    return resp
+
+
+def _decode_response(encoded, url):
+    resp = requests.Response()
+    resp.status_code = encoded["status"]
+    resp.reason = encoded["reason"]
+    resp.headers = requests.structures.CaseInsensitiveDict(encoded["headers"])
+    resp.url = url
+    resp.encoding = "utf-8"
+    if "body_b64" in encoded:
+        resp._content = base64.b64decode(encoded["body_b64"])
+    else:
+        resp._content = encoded["body"].encode("utf-8")
+    return resp
+
+
+def _not_modified(resp, headers):
+    if resp.status_code != 200 or not headers:
+        return False
+    headers = requests.structures.CaseInsensitiveDict(headers)
+    etag = resp.headers.get("etag")
+    if etag and headers.get("if-none-match") == etag:
+        return True
+    last_modified = resp.headers.get("last-modified")
+    return bool(last_modified and headers.get("if-modified-since") == last_modified)
+
+
+def _not_modified_response(resp):
+    not_modified = requests.Response()
+    not_modified.status_code = 304
+    not_modified.reason = "Not Modified"
+    not_modified.headers = requests.structures.CaseInsensitiveDict(
+        {
+            name: val
+            for name, val in resp.headers.items()
+            if name.lower() in ("etag", "last-modified")
+        }
+    )
+    not_modified.url = resp.url
+    not_modified._content = b""
+    return not_modified
+
+
+def _read_exchanges(path):
+    try:
+        f = open(path, encoding="utf-8")
+    except FileNotFoundError:
+        raise SystemExit("cannot replay: %s does not exist" % path)
+    exchanges = {}
+    with f:
+        for line in f:
+            if line.strip():
+                exchange = json.loads(line)
+                key = (exchange["type"], exchange["key"])
+                exchanges.setdefault(key, []).append(exchange)
+    return exchanges
+
+
+###################################################################
+# Active recorder
+###################################################################
+
+
+def start_record(dir):
+    global _recorder
+    _recorder = Recorder(dir)
+    _use_private_cache()
+    log.info("Recording exchanges to %s", dir)
+
+
+def start_replay(dir, latency=None):
+    global _recorder
+    _recorder = Replayer(dir, latency)
+    _use_private_cache()
+    log.info("Replaying exchanges from %s", dir)
+
+
+def _use_private_cache():
+    """Uses an empty, temporary cache unless MY_GUILD_CACHE_DIR is set.
+
+    Values read from a shared cache would otherwise be missing from
+    recordings and mask replayed exchanges.
+    """
+    if os.getenv("MY_GUILD_CACHE_DIR"):
+        return
+    cache_dir = tempfile.mkdtemp(prefix="myguild-cache-")
+    atexit.register(_remove_private_cache, cache_dir)
+    cache.set_cache_dir(cache_dir)
+
+
+def _remove_private_cache(cache_dir):
+    # Runs before the cache's own exit handler - flush and close
+    # first so the cache isn't reopened in the removed directory.
+    cache.flush_usage()
+    cache.set_cache_dir(cache_dir)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def stop():
+    global _recorder
+    if _recorder:
+        _recorder.close()
+        _recorder = None
+
+
+def active():
+    """Returns the active recorder or replayer, or None."""
+    return _recorder
+
+
+def replaying():
+    return _recorder is not None and _recorder.mode == "replay"
+
+
+def http_request(send, method, url, kw):
+    """Sends a request using send, recording or replaying as active."""
+    if _recorder is None:
+        return send(method, url, **kw)
+    return _recorder.http_request(send, method, url, kw)
+
+
+async def http_request_async(send, method, url, kw):
+    """Async version of `http_request` - send is a coroutine function."""
+    if _recorder is None:
+        return await send(method, url, **kw)
+    return await _recorder.http_request_async(send, method, url, kw)
+
+
+def call(kind, key, f, errors=()):
+    """Calls f, recording or replaying its result as active.
+
+    `f` must return a JSON serializable value. Exceptions of the types
+    in `errors` are recorded and raised again on replay. Their args
+    must be JSON serializable.
+    """
+    if _recorder is None:
+        return f()
+    return _recorder.call(kind, key, f, tuple(errors))
@@ -0,0 +1,84 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import threading
+import time
+
+from .log_util import get_logger
+
+log = get_logger()
+
+_trace_file = None
+_trace_lock = threading.Lock()
+
+# Correlation ID of the logical item being processed. Context
+# variables aren't inherited by pool threads - use `util.pool_imap` or
+# `contextvars.copy_context` to run work in the caller's context.
+_correlation_id = contextvars.ContextVar("myguild_trace_correlation_id", default=None)
+
+
+def start(path):
+    """Writes trace events to path as JSON lines.
+
+    Existing events in path are replaced.
+    """
+    global _trace_file
+    stop()
+    _trace_file = open(path, "w", encoding="utf-8")
+    atexit.register(stop)
+    log.info("Writing trace events to %s", path)
+
+
+def stop():
+    global _trace_file
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+            _trace_file = None
+
+
+def active():
+    return _trace_file is not None
+
+
+def event(name, **attrs):
+    """Writes a trace event.
+
+    Events include the time, the correlation ID set by `correlation`,
+    and the name of the thread that writes the event. Does nothing if
+    tracing is not active.
+    """
+    if _trace_file is None:
+        return
+    data = {
+        "time": round(time.time(), 6),
+        "event": name,
+        "id": _correlation_id.get(),
+        "thread": threading.current_thread().name,
+    }
+    data.update(attrs)
+    line = json.dumps(data, default=str)
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.write(line + "\n")
+            _trace_file.flush()
+
+
+@contextlib.contextmanager
+def correlation(id):
+    """Sets the correlation ID for events written in the block.
+
+    Use IDs of the form `<type>:<val>` - e.g. 'command:run',
+    'topic:123' or 'link:docs/runs'.
+    """
+    token = _correlation_id.set(id)
+    try:
+        yield
+    finally:
+        _correlation_id.reset(token)
+
+
+def elapsed(t0):
+    """Returns seconds since t0 rounded for trace events."""
+    return round(time.time() - t0, 6)
@@ -1,9 +1,17 @@
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import difflib
 import errno
 import logging
 import os
 import shlex
 import subprocess
+import sys
+import tempfile
 import textwrap
+import threading
 import time
 
 import click
@@ -15,6 +23,8 @@ except NameError:
 
 from .log_util import get_logger
 
+from . import trace
+
 log = get_logger()
 
 
@@ -58,13 +68,156 @@ def edit(path, editor=None):
     return click.edit(filename=path, editor=editor)
 
 
-def diff_files(path1, path2, diff_cmd=None):
-    diff_cmd = shlex.split(diff_cmd or default_diff_cmd()) + [path1, path2]
-    subprocess.call(diff_cmd)
+def diff_files(path1, path2, diff_cmd=None, color=None):
+    diff_files_many([(path1, path2)], diff_cmd, color)
+
+
+def diff_files_many(path_pairs, diff_cmd=None, color=None):
+    """Shows diffs for an iterable of (path1, path2) pairs.
+
+    If `diff_cmd` is specified or `DIFF` is set, the command is run for
+    each pair. Otherwise diffs are generated in process and shown using
+    a single pager. Identical files are skipped.
+
+    `color` may be True or False to enable or disable color for
+    generated diffs. By default, color is used when stdout is a
+    terminal.
+    """
+    diff_cmd = diff_cmd or os.getenv("DIFF")
+    if diff_cmd:
+        for path1, path2 in path_pairs:
+            subprocess.call(shlex.split(diff_cmd) + [path1, path2])
+    else:
+        color = sys.stdout.isatty() if color is None else color
+        with pager() as out:
+            for path1, path2 in path_pairs:
+                lines = unified_diff(
+                    read_utf(path1),
+                    read_utf(path2),
+                    os.path.relpath(path1),
+                    os.path.relpath(path2),
+                )
+                if not _write_diff_lines(lines, out, color):
+                    break
+
+
+def diff_strings(s1, s2, label1, label2, diff_cmd=None, color=None):
+    """Shows a diff of two strings.
+
+    Uses `diff_cmd` or `DIFF` if specified, in which case the strings
+    are written to temporary files named `label1` and `label2`.
+    """
+    diff_cmd = diff_cmd or os.getenv("DIFF")
+    if diff_cmd:
+        with tempfile.TemporaryDirectory(prefix="myguild-diff-") as tmp:
+            path1 = os.path.join(tmp, label1)
+            path2 = os.path.join(tmp, label2)
+            write_utf(path1, s1)
+            write_utf(path2, s2)
+            subprocess.call(shlex.split(diff_cmd) + [path1, path2])
+    else:
+        color = sys.stdout.isatty() if color is None else color
+        with pager() as out:
+            _write_diff_lines(unified_diff(s1, s2, label1, label2), out, color)
+
+
+def unified_diff(s1, s2, label1, label2):
+    """Returns an iterator of unified diff lines for two strings.
+
+    Lines are formatted as they are by `diff -u`.
+    """
+    lines1 = _diff_input_lines(s1)
+    lines2 = _diff_input_lines(s2)
+    return difflib.unified_diff(lines1, lines2, label1, label2)
+
+
+def _diff_input_lines(s):
+    lines = s.splitlines(True)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n\\ No newline at end of file\n"
+    return lines
+
+
+_DIFF_COLORS = [
+    ("---", "\033[1m"),
+    ("+++", "\033[1m"),
+    ("@@", "\033[36m"),
+    ("-", "\033[31m"),
+    ("+", "\033[32m"),
+]
+
+
+def _write_diff_lines(lines, out, color):
+    """Writes diff lines to out.
+
+    Returns False if out is closed (e.g. the pager exited).
+    """
+    try:
+        for line in lines:
+            out.write(_color_diff_line(line) if color else line)
+        out.flush()
+    except BrokenPipeError:
+        return False
+    return True
+
+
+def _color_diff_line(line):
+    for prefix, code in _DIFF_COLORS:
+        if line.startswith(prefix):
+            body = line.rstrip("\n")
+            return "%s%s\033[0m%s" % (code, body, line[len(body) :])
+    return line
+
+
+@contextlib.contextmanager
+def pager():
+    """Context manager that yields a stream for paged output.
+
+    Uses `PAGER` or `less` when stdout is a terminal. Otherwise yields
+    stdout.
+    """
+    if not sys.stdout.isatty():
+        yield sys.stdout
+        return
+    cmd = shlex.split(os.getenv("PAGER") or "less")
+    env = dict(os.environ)
+    env.setdefault("LESS", "FRX")
+    try:
+        p = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, env=env, encoding="utf-8", errors="replace"
+        )
+    except OSError as e:
+        log.debug("cannot start pager %s: %s", cmd, e)
+        yield sys.stdout
+        return
+    try:
+        yield p.stdin
+    finally:
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+        p.wait()
+
 
+def write_atomic(path, s):
+    """Writes s to path atomically.
 
-def default_diff_cmd():
-    return os.getenv("DIFF") or "diff -u --color"
+    s is written to a temporary file in the same directory, which is
+    synced and then renamed to path. Readers see either the previous
+    file or the complete new file.
+    """
+    dir = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        ensure_deleted(tmp_path)
+        raise
 
 
 def ensure_deleted(path):
@@ -79,9 +232,19 @@ def retry(desc, f, max_attempts=3, delay=3):
     attempts = 0
     while True:
         attempts += 1
+        t0 = time.time()
         try:
             return f()
         except Exception as e:
+            trace.event(
+                "retry",
+                desc=desc,
+                attempt=attempts,
+                max_attempts=max_attempts,
+                retrying=attempts < max_attempts,
+                error=repr(e),
+                seconds=trace.elapsed(t0),
+            )
             if attempts == max_attempts:
                 raise
             if log.getEffectiveLevel() <= logging.DEBUG:
@@ -91,6 +254,40 @@ def retry(desc, f, max_attempts=3, delay=3):
             time.sleep(delay)
 
 
+def pool_imap(f, items, jobs=1):
+    """Applies `f` to each of `items` using a bounded thread pool.
+
+    Generates `(item, future)` tuples in item order. Up to `jobs`
+    calls are submitted at a time. A call for the next item is
+    submitted only when the caller asks for the next tuple, so no new
+    calls start once the caller stops iterating (e.g. on an error).
+
+    Calls run in a copy of the caller's context so that context
+    variables such as the trace correlation ID are inherited.
+    """
+    jobs = max(jobs, 1)
+    items = iter(items)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    pending = collections.deque()
+
+    def submit_next():
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        future = executor.submit(contextvars.copy_context().run, f, item)
+        pending.append((item, future))
+
+    try:
+        for _ in range(jobs):
+            submit_next()
+        while pending:
+            yield pending.popleft()
+            submit_next()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def mtime(path):
     return os.stat(path).st_mtime
 
@@ -128,6 +325,47 @@ class SafeLoop(object):
             self._count = 1
 
 
+class LRUCache(object):
+    """Thread safe in-memory cache that holds up to `max_size` items.
+
+    When full, the least recently used item is dropped to make room
+    for a new item.
+    """
+
+    _missing = object()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            val = self._items.get(key, self._missing)
+            if val is self._missing:
+                return default
+            self._items.move_to_end(key)
+            return val
+
+    def put(self, key, val):
+        with self._lock:
+            self._items[key] = val
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
 def notify_send(msg, urgency=None):
     cmd = ["notify-send", msg]
     if urgency: